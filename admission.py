@@ -0,0 +1,128 @@
+"""
+Admission control and load shedding for the AI stage.
+
+Before a message is queued for AI generation the ingest task asks whether
+the AI pipeline is overloaded: the ``ai`` Celery queue is deeper than
+SHED_QUEUE_DEPTH, or the cluster-wide moving average of OpenAI latency is
+above SHED_AI_LATENCY_MS. Under overload the guest gets an immediate canned
+answer when the question matches one of the knowledge base's Q&A pairs (so
+the answers follow knowledge-base updates), otherwise a holding message
+and the conversation is flagged for an agent. Work that has waited longer
+than AI_STALE_SECONDS by the time the AI stage picks it up is dropped the
+same way instead of being answered minutes late.
+
+The depth is LLEN of the queue, which only counts tasks no worker has
+reserved yet, so the AI worker runs with --prefetch-multiplier=1 (see
+Procfile/render.yaml): otherwise each process would hold up to four tasks
+per greenlet in Celery's unacked set, invisible to this check.
+
+Readings are cached in-process for ADMISSION_SAMPLE_SECONDS so the checks
+cost at most one Redis round trip per second per process.
+"""
+
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timezone
+
+import redis
+
+import knowledge_base
+
+logger = logging.getLogger("chat_server")
+
+AI_QUEUE_NAME = os.getenv("AI_QUEUE_NAME", "ai")
+SHED_QUEUE_DEPTH = int(os.getenv("SHED_QUEUE_DEPTH", "200"))
+SHED_AI_LATENCY_MS = float(os.getenv("SHED_AI_LATENCY_MS", "20000"))
+AI_STALE_SECONDS = float(os.getenv("AI_STALE_SECONDS", "120"))
+ADMISSION_SAMPLE_SECONDS = float(os.getenv("ADMISSION_SAMPLE_SECONDS", "1"))
+
+AI_LATENCY_KEY = "ai:latency_ewma_ms"
+AI_LATENCY_EWMA_ALPHA = 0.2
+# Forget the average after a quiet period so one slow burst doesn't shed forever
+AI_LATENCY_TTL = 300
+
+_ewma_script = """
+local current = tonumber(redis.call('get', KEYS[1]))
+local sample = tonumber(ARGV[1])
+if current then
+    sample = current + tonumber(ARGV[2]) * (sample - current)
+end
+redis.call('set', KEYS[1], sample, 'EX', ARGV[3])
+return tostring(sample)
+"""
+
+HOLDING_REPLIES = {
+    "en": "Thanks for your message! We're receiving a lot of messages right now, so a member of our team will get back to you shortly.",
+    "es": "¡Gracias por tu mensaje! En este momento estamos recibiendo muchos mensajes, así que un miembro de nuestro equipo te responderá en breve.",
+}
+
+
+def holding_reply(language):
+    return HOLDING_REPLIES.get(language, HOLDING_REPLIES["en"])
+
+
+def canned_reply(message, language):
+    """Return the knowledge base's stored answer if the message asks one of its Q&A questions."""
+    return knowledge_base.get().faq_answer(message, language)
+
+
+class AdmissionController:
+    """Decides whether new AI work should be admitted, from shared Redis readings."""
+
+    def __init__(self, redis_client):
+        self._redis = redis_client
+        self._update_ewma = redis_client.register_script(_ewma_script)
+        self._lock = threading.Lock()
+        self._sampled_at = 0.0
+        self._queue_depth = 0
+        self._latency_ms = 0.0
+
+    def record_ai_latency(self, latency_ms):
+        try:
+            self._update_ewma(keys=[AI_LATENCY_KEY], args=[latency_ms, AI_LATENCY_EWMA_ALPHA, AI_LATENCY_TTL])
+        except redis.RedisError as e:
+            logger.warning(f"Failed to record AI latency: {e}")
+
+    def _sample(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._sampled_at < ADMISSION_SAMPLE_SECONDS:
+                return self._queue_depth, self._latency_ms
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.llen(AI_QUEUE_NAME)
+        pipe.get(AI_LATENCY_KEY)
+        queue_depth, latency_ms = pipe.execute()
+        with self._lock:
+            self._sampled_at = now
+            self._queue_depth = int(queue_depth or 0)
+            self._latency_ms = float(latency_ms or 0)
+            return self._queue_depth, self._latency_ms
+
+    def overload_reason(self):
+        """Return why new AI work should be shed, or None to admit it."""
+        try:
+            queue_depth, latency_ms = self._sample()
+        except redis.RedisError as e:
+            # Fail open: shedding on a Redis blip would hurt more than it helps
+            logger.warning(f"Admission check failed, admitting: {e}")
+            return None
+        if queue_depth > SHED_QUEUE_DEPTH:
+            return "queue_depth"
+        if latency_ms > SHED_AI_LATENCY_MS:
+            return "ai_latency"
+        return None
+
+    @staticmethod
+    def is_stale(user_timestamp):
+        """True if a message sent at user_timestamp (ISO 8601) is too old to answer."""
+        if not user_timestamp:
+            return False
+        try:
+            sent_at = datetime.fromisoformat(user_timestamp)
+        except ValueError:
+            return False
+        if sent_at.tzinfo is None:
+            sent_at = sent_at.replace(tzinfo=timezone.utc)
+        return (datetime.now(timezone.utc) - sent_at).total_seconds() > AI_STALE_SECONDS
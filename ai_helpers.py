@@ -1,10 +1,17 @@
 import os
 import time
+import threading
+import httpx
 import openai
 from openai import OpenAI, RateLimitError, APIError, AuthenticationError, APITimeoutError
 import logging
 from circuitbreaker import CircuitBreaker
 from dotenv import load_dotenv
+import knowledge_base
+import prompt_builder
+import token_budget
+from token_budget import AI_MODEL
+import metrics
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 
 load_dotenv()
@@ -13,10 +20,33 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Upper bound on concurrent OpenAI completions per process. Only matters under
+# the gevent worker pool, where one process keeps many completions in flight.
+AI_MAX_INFLIGHT = int(os.getenv("AI_MAX_INFLIGHT", "200"))
+_inflight_slots = threading.BoundedSemaphore(AI_MAX_INFLIGHT)
+
+# Time limits of one get_ai_response call. Each OpenAI request is capped at
+# OPENAI_TIMEOUT_SECONDS (streams included) and retried only by tenacity
+# below, not also inside the SDK, so AI_CALL_MAX_SECONDS bounds the whole
+# call. tasks.py sizes the per-conversation generation lease from it.
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "30"))
+AI_MAX_ATTEMPTS = 5
+AI_RETRY_MAX_WAIT = 30
+AI_CALL_MAX_SECONDS = AI_MAX_ATTEMPTS * OPENAI_TIMEOUT_SECONDS + (AI_MAX_ATTEMPTS - 1) * AI_RETRY_MAX_WAIT
+
 # Initialize OpenAI client
 try:
     # Use a more descriptive variable name to avoid conflict with the module name
-    openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+    openai_client = OpenAI(
+        api_key=os.environ.get("OPENAI_API_KEY"),
+        timeout=OPENAI_TIMEOUT_SECONDS,
+        max_retries=0,
+        # Size the keep-alive pool for AI_MAX_INFLIGHT concurrent requests
+        http_client=httpx.Client(limits=httpx.Limits(
+            max_connections=AI_MAX_INFLIGHT,
+            max_keepalive_connections=AI_MAX_INFLIGHT
+        ))
+    )
     logger.info("✅ OpenAI client initialized successfully.")
 except KeyError:
     logger.error("❌ OPENAI_API_KEY environment variable not set.")
@@ -25,24 +55,81 @@ except Exception as e:
     logger.error(f"❌ Failed to initialize OpenAI client: {e}")
     openai_client = None
 
+# Most recent conversation turns loaded (and kept in the context cache) as
+# candidates for the prompt; how many are sent is decided by the model's
+# token budget (token_budget.history_budget).
+AI_HISTORY_WINDOW = int(os.getenv("AI_HISTORY_WINDOW", "40"))
+
+# Guest turns used to pick knowledge-base sections for the prompt
+KB_QUERY_TURNS = int(os.getenv("KB_QUERY_TURNS", "2"))
+
+# Replies returned when no answer could be generated; callers must not reuse them
+REPLY_UNAVAILABLE = "I am currently unable to process requests."
+REPLY_EMPTY = "I could not generate a response at this time."
+REPLY_MISCONFIGURED = "There's an issue with my configuration. Please notify an administrator."
+REPLY_UNEXPECTED_ERROR = "An unexpected error occurred. I've logged the issue."
+FALLBACK_REPLIES = frozenset((REPLY_UNAVAILABLE, REPLY_EMPTY, REPLY_MISCONFIGURED, REPLY_UNEXPECTED_ERROR))
+
 # Circuit Breaker for OpenAI API
 circuit_breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=60)
 
-@circuit_breaker.call
+def _retrieval_query(conversation_history):
+    """The last KB_QUERY_TURNS user turns, so follow-ups like "and for a villa?" keep their topic."""
+    user_turns = [msg.get("content", "") for msg in conversation_history if msg.get("role") == "user"]
+    return " ".join(user_turns[-KB_QUERY_TURNS:])
+
+def _usage_field(obj, name):
+    # Fields newer than the pinned SDK arrive as untyped extras, i.e. plain dicts
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+def _stream_completion(messages, on_text):
+    """
+    Stream a completion, calling on_text with the reply so far after each chunk.
+    Returns (text, usage); usage comes from the final chunk OpenAI sends when
+    asked to include it.
+    """
+    text = ""
+    usage = None
+    deadline = time.monotonic() + OPENAI_TIMEOUT_SECONDS
+    stream = openai_client.chat.completions.create(
+        model=AI_MODEL,
+        messages=messages, # type: ignore
+        max_tokens=300,
+        temperature=0.7,
+        stream=True,
+        # stream_options isn't a parameter of the pinned SDK yet
+        extra_body={"stream_options": {"include_usage": True}}
+    )
+    for chunk in stream:
+        # The client timeout applies per read; a trickling stream is cut here
+        if time.monotonic() > deadline:
+            stream.response.close()
+            raise APITimeoutError(request=stream.response.request)
+        if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+            text += chunk.choices[0].delta.content
+            on_text(text)
+        usage = _usage_field(chunk, "usage") or usage
+    return text, usage
+
+@circuit_breaker
 @retry(
-    stop=stop_after_attempt(5),
-    wait=wait_exponential(multiplier=2, min=4, max=30),
+    stop=stop_after_attempt(AI_MAX_ATTEMPTS),
+    wait=wait_exponential(multiplier=2, min=4, max=AI_RETRY_MAX_WAIT),
     retry=retry_if_exception_type((APITimeoutError, RateLimitError, APIError))
 )
-def get_ai_response(convo_id, username, conversation_history, user_message, chat_id, channel, language="en", correlation_id=None):
+def get_ai_response(convo_id, username, conversation_history, user_message, chat_id, channel, language="en", correlation_id=None, on_text=None):
     """
     Synchronous function to get AI responses using the OpenAI API.
     Returns: ai_reply, detected_intent, handoff_triggered
     Enhanced with circuit breaker, retry, and production-grade error handling.
+    If on_text is given the completion is streamed and on_text is called with
+    the reply so far after every chunk (from the start again on a retry).
     """
     if not openai_client:
         logger.error("OpenAI client is not initialized. Cannot get AI response.")
-        return "I am currently unable to process requests.", None, False
+        return REPLY_UNAVAILABLE, None, False
 
     if not correlation_id:
         correlation_id = f"convo-{convo_id}-{int(time.time())}"
@@ -60,40 +147,52 @@ def get_ai_response(convo_id, username, conversation_history, user_message, chat
     if not conversation_history or conversation_history[-1].get("content") != user_message or conversation_history[-1].get("role") != "user":
         conversation_history.append({"role": "user", "content": user_message})
     
-    # Limit history length to avoid excessive token usage (e.g., last 10 messages)
-    MAX_HISTORY_LEN = 10
-    if len(conversation_history) > MAX_HISTORY_LEN:
-        conversation_history = conversation_history[-MAX_HISTORY_LEN:]
-        logger.debug(f"Trimmed conversation history to last {MAX_HISTORY_LEN} messages for convo_id {convo_id}")
+    # Pack the most recent turns into the model's history token budget
+    candidate_turns = len(conversation_history)
+    conversation_history, history_tokens = token_budget.pack_history(conversation_history, token_budget.history_budget(AI_MODEL))
+    metrics.observe("ai.history_tokens", history_tokens)
+    metrics.observe("ai.history_messages", len(conversation_history))
+    logger.debug(f"Packed {len(conversation_history)}/{candidate_turns} turns ({history_tokens} tokens) of history for convo_id {convo_id}")
     
-    system_prompt = f"You are a helpful assistant for Amapola Resort. Current language for response: {language}."
-    messages_for_openai = [
-        {"role": "system", "content": system_prompt}
-    ] + conversation_history
+    # Stable, cacheable prefix first; the sections retrieved for this turn go last
+    kb = knowledge_base.get()
+    sections = kb.search(_retrieval_query(conversation_history))
+    messages_for_openai = prompt_builder.build_messages(kb, language, conversation_history, sections)
     
     ai_reply = None
     detected_intent = None
     handoff_triggered = False
     request_start_time = time.time()
     try:
-        logger.info(f"[CID:{correlation_id}] Calling OpenAI API for convo_id {convo_id}. Model: gpt-4o-mini. History length: {len(messages_for_openai)}")
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages_for_openai, # type: ignore
-            max_tokens=300,
-            temperature=0.7
-        )
+        logger.info(f"[CID:{correlation_id}] Calling OpenAI API for convo_id {convo_id}. Model: {AI_MODEL}. History length: {len(messages_for_openai)}")
+        usage = None
+        with _inflight_slots:
+            if on_text:
+                content, usage = _stream_completion(messages_for_openai, on_text)
+            else:
+                response = openai_client.chat.completions.create(
+                    model=AI_MODEL,
+                    messages=messages_for_openai, # type: ignore
+                    max_tokens=300,
+                    temperature=0.7
+                )
+                content = response.choices[0].message.content if response.choices and response.choices[0].message else None
+                usage = response.usage
         
-        if response.choices and response.choices[0].message and response.choices[0].message.content:
-            ai_reply = response.choices[0].message.content.strip()
+        if content:
+            ai_reply = content.strip()
         else:
-            ai_reply = "I could not generate a response at this time."
+            ai_reply = REPLY_EMPTY
             logger.error(f"[CID:{correlation_id}] OpenAI response was empty or invalid.")
 
-        usage = response.usage
         if usage:
             processing_time = (time.time() - request_start_time) * 1000
-            logger.info(f"[CID:{correlation_id}] [OpenAI Response] Convo ID: {convo_id} - Reply: '{ai_reply[:100]}...' - Tokens: P{usage.prompt_tokens}/C{usage.completion_tokens}/T{usage.total_tokens} - Time: {processing_time:.2f}ms")
+            # A streamed call's usage is a plain dict, and so is prompt_tokens_details
+            prompt_tokens = _usage_field(usage, "prompt_tokens") or 0
+            cached_tokens = _usage_field(_usage_field(usage, "prompt_tokens_details"), "cached_tokens") or 0
+            metrics.observe("ai.prompt_tokens", prompt_tokens)
+            metrics.observe("ai.cached_tokens", cached_tokens)
+            logger.info(f"[CID:{correlation_id}] [OpenAI Response] Convo ID: {convo_id} - Reply: '{ai_reply[:100]}...' - Tokens: P{prompt_tokens}(cached {cached_tokens})/C{_usage_field(usage, 'completion_tokens')}/T{_usage_field(usage, 'total_tokens')} - Time: {processing_time:.2f}ms")
         
         # Basic intent detection (example - can be expanded)
         if "book a room" in user_message.lower() or "reservation" in user_message.lower():
@@ -116,11 +215,11 @@ def get_ai_response(convo_id, username, conversation_history, user_message, chat
         raise # Reraise to trigger retry
     except AuthenticationError as e:
         logger.critical(f"❌ OpenAI AuthenticationError for convo_id {convo_id}: {str(e)} (Check API Key)", exc_info=True)
-        ai_reply = "There's an issue with my configuration. Please notify an administrator."
+        ai_reply = REPLY_MISCONFIGURED
         # Do not retry on auth errors
     except Exception as e:
         logger.error(f"❌ Unexpected error in get_ai_response for convo_id {convo_id}: {str(e)}", exc_info=True)
-        ai_reply = "An unexpected error occurred. I've logged the issue."
+        ai_reply = REPLY_UNEXPECTED_ERROR
     
     processing_time = time.time() - start_time_ai
     logger.info(f"GET_AI_RESPONSE for convo_id {convo_id} completed in {processing_time:.2f}s. Intent: {detected_intent}, Handoff: {handoff_triggered}")
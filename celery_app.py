@@ -1,10 +1,19 @@
-from celery import Celery
+from celery import Celery, signals
+from datetime import datetime
 import os
+import time
+import metrics
 
 BROKER_URL = os.getenv('REDIS_URL', 'redis://red-cvfhn5nnoe9s73bhmct0:6379')
 
 celery_app = Celery('tasks', broker=BROKER_URL, backend=BROKER_URL)
 
+# Queue topology (each class has its own worker service, see Procfile/render.yaml):
+#   agent    - agent-typed messages to WhatsApp guests, drained first
+#   delivery - outbound AI replies
+#   ai       - OpenAI generation (gevent pool, can back up under load)
+#   ingest   - persisting inbound messages
+# A worker consuming several queues polls them in the order given to -Q.
 celery_app.conf.update(
     task_serializer='json',
     accept_content=['json'],
@@ -13,11 +22,39 @@ celery_app.conf.update(
     enable_utc=True,
     worker_concurrency=9,
     task_routes={
-        'tasks.process_incoming_message': {'queue': 'whatsapp'},
-        'tasks.send_whatsapp_message_task': {'queue': 'whatsapp'}
+        # Inbound pipeline stages, see tasks.py
+        'tasks.process_incoming_message': {'queue': 'ingest'},
+        'tasks.generate_ai_reply': {'queue': 'ai'},
+        'tasks.deliver_ai_reply': {'queue': 'delivery'},
+        'tasks.send_whatsapp_message_task': {'queue': 'agent'}
     },
     task_default_queue='default',
+    broker_transport_options={'queue_order_strategy': 'priority'},
     broker_connection_retry_on_startup=True,
     task_acks_late=True,
     task_reject_on_worker_lost=True
 )
+
+
+@signals.before_task_publish.connect
+def _stamp_enqueue_time(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault('enqueued_at', time.time())
+
+
+@signals.task_prerun.connect
+def _record_queue_latency(task=None, **kwargs):
+    """Record how long each task waited in its queue, as queue.<name>.latency_ms."""
+    request = task.request
+    enqueued_at = getattr(request, 'enqueued_at', None)
+    if not enqueued_at:
+        return
+    # Deliberate delays (countdown/eta, e.g. AI debouncing) aren't queueing time
+    ready_at = float(enqueued_at)
+    if request.eta:
+        try:
+            ready_at = max(ready_at, datetime.fromisoformat(request.eta).timestamp())
+        except (TypeError, ValueError):
+            pass
+    queue = (request.delivery_info or {}).get('routing_key') or 'unknown'
+    metrics.observe(f"queue.{queue}.latency_ms", max(0.0, (time.time() - ready_at) * 1000))
@@ -27,6 +27,6 @@ if __name__ == "__main__":
         "worker",
         "--loglevel=info",
         "-E",  # Enable events for monitoring
-        "--queues=default,whatsapp",  # Specify the queues to listen to
+        "--queues=agent,delivery,ingest,ai,default",  # Polled in this order (highest priority first)
         "--concurrency=9"  # Match the worker_concurrency setting
     ])
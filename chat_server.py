@@ -25,13 +25,20 @@ import requests
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from cachetools import TTLCache
 from concurrent_log_handler import ConcurrentRotatingFileHandler
 from langdetect import detect, DetectorFactory
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 from functools import wraps
 from celery_app import celery_app
+import metrics
+import context_cache
+import settings_service
+import delivery_status
+import knowledge_base
+import response_cache
+import token_budget
 from werkzeug.middleware.proxy_fix import ProxyFix
+from twilio.request_validator import RequestValidator
 
 DetectorFactory.seed = 0
 
@@ -184,9 +191,6 @@ login_manager.login_view = 'login' # type: ignore
 
 # --- GLOBAL CACHES & CONFIGS ---
 
-# Cache for ai_enabled setting with 5-second TTL
-settings_cache = TTLCache(maxsize=1, ttl=5) # type: ignore
-
 # Load or define the Q&A reference document
 try:
     logger.debug("Attempting to load qa_reference.txt")
@@ -252,6 +256,24 @@ def initialize_database():
         """)
         logger.info("Table 'messages' checked/created.")
 
+        # Provider/client message id used to drop redelivered inbound messages
+        c.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS external_id VARCHAR(255)")
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_external_id ON messages (external_id)")
+        logger.info("Column 'messages.external_id' and its unique index checked/created.")
+
+        # Latest Twilio delivery status of outbound WhatsApp messages
+        c.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS delivery_status VARCHAR(20)")
+        c.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS delivery_updated_at TIMESTAMP WITH TIME ZONE")
+        logger.info("Columns 'messages.delivery_status' and 'messages.delivery_updated_at' checked/created.")
+
+        # Token count of each message, summed when packing AI history into the token budget
+        c.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS token_count INTEGER")
+        logger.info("Column 'messages.token_count' checked/created.")
+
+        # Serves the bounded "latest N messages" history read in tasks.py
+        c.execute("CREATE INDEX IF NOT EXISTS idx_messages_convo_id_timestamp ON messages (convo_id, timestamp)")
+        logger.info("Index 'idx_messages_convo_id_timestamp' checked/created.")
+
         # Settings table
         c.execute("""
             CREATE TABLE IF NOT EXISTS settings (
@@ -378,38 +400,32 @@ def with_db_retry(func):
     return wrapper
 
 # --- APPLICATION HELPERS ---
-@with_db_retry
-def get_ai_enabled():
-    if "ai_enabled" in settings_cache:
-        cached_value, cached_timestamp = settings_cache["ai_enabled"]
-        logger.debug(f"CACHE HIT: ai_enabled='{cached_value}', timestamp='{cached_timestamp}'")
-        return cached_value, cached_timestamp
-    
+def _load_ai_enabled_setting():
     conn = None
     try:
         conn = get_db_connection()
         c = conn.cursor()
         c.execute("SELECT value, last_updated FROM settings WHERE key = %s", ("ai_enabled",))
         result = c.fetchone()
-        
         if result:
-            value = result['value']
-            timestamp = result['last_updated']
-            settings_cache["ai_enabled"] = (value, timestamp)
-            logger.debug(f"CACHE MISS: Updated ai_enabled='{value}', timestamp='{timestamp}'")
-            return value, timestamp
-        else:
-            # Default to enabled if no setting found
-            logger.warning("No ai_enabled setting found in database, defaulting to enabled")
-            return "1", datetime.now(timezone.utc).isoformat()
-    except Exception as e:
-        logger.error(f"Failed to get ai_enabled setting: {str(e)}", exc_info=True)
-        # Default to enabled on error
+            return result['value'], result['last_updated']
+        # Default to enabled if no setting found
+        logger.warning("No ai_enabled setting found in database, defaulting to enabled")
         return "1", datetime.now(timezone.utc).isoformat()
     finally:
         if conn:
             release_db_connection(conn)
 
+@with_db_retry
+def get_ai_enabled():
+    """Global AI flag as (value, last_updated), served from the shared settings cache."""
+    try:
+        return settings_service.get(settings_service.GLOBAL_AI_ENABLED, _load_ai_enabled_setting)
+    except Exception as e:
+        logger.error(f"Failed to get ai_enabled setting: {str(e)}", exc_info=True)
+        # Default to enabled on error
+        return "1", datetime.now(timezone.utc).isoformat()
+
 # --- USER AUTHENTICATION ---
 # User model for Flask-Login
 class User(UserMixin):
@@ -562,7 +578,7 @@ def get_messages(convo_id):
         # Get messages
         c.execute(
             """
-            SELECT id, username, message, sender, timestamp
+            SELECT id, username, message, sender, timestamp, delivery_status
             FROM messages
             WHERE convo_id = %s
             ORDER BY timestamp ASC
@@ -589,7 +605,8 @@ def get_messages(convo_id):
                 "username": msg['username'],
                 "message": msg['message'],
                 "sender": msg['sender'],
-                "timestamp": msg['timestamp']
+                "timestamp": msg['timestamp'],
+                "delivery_status": msg['delivery_status']
             })
         
         return jsonify(result)
@@ -600,6 +617,71 @@ def get_messages(convo_id):
         if conn:
             release_db_connection(conn)
 
+@app.route('/api/metrics', methods=['GET'])
+@login_required
+def get_metrics():
+    """Cluster-wide counters and per-process gauges (DB pool, queues, caches)."""
+    try:
+        return jsonify(metrics.snapshot())
+    except Exception as e:
+        logger.error(f"Failed to read metrics: {str(e)}", exc_info=True)
+        return jsonify({"error": "Failed to retrieve metrics"}), 500
+
+@app.route('/api/knowledge-base', methods=['GET'])
+@login_required
+def get_knowledge_base():
+    """The knowledge base version every process is converging on."""
+    try:
+        kb = knowledge_base.get()
+        return jsonify({
+            "version": kb.version,
+            "sections": len(kb.sections),
+            "current": knowledge_base.redis_client.get(knowledge_base.KB_CURRENT_KEY)
+        })
+    except Exception as e:
+        logger.error(f"Failed to read knowledge base: {str(e)}", exc_info=True)
+        return jsonify({"error": "Failed to retrieve knowledge base"}), 500
+
+@app.route('/api/knowledge-base', methods=['POST'])
+@login_required
+def publish_knowledge_base():
+    """Publish an edited reference document; web and Celery processes swap it in without a restart."""
+    data = request.json
+    text = (data or {}).get('text', '')
+    if not text.strip():
+        return jsonify({"error": "Knowledge base text cannot be empty"}), 400
+    if not knowledge_base.split_sections(text)[1]:
+        return jsonify({"error": "Knowledge base has no **Heading** sections"}), 400
+    try:
+        version = knowledge_base.publish(text)
+        logger.info(f"Knowledge base version {version} published by {current_user.username}")
+        return jsonify({"success": True, "version": version})
+    except Exception as e:
+        logger.error(f"Failed to publish knowledge base: {str(e)}", exc_info=True)
+        return jsonify({"error": "Failed to publish knowledge base"}), 500
+
+@app.route('/api/ai/reject-answer/<int:message_id>', methods=['POST'])
+@login_required
+def reject_ai_answer(message_id):
+    """Stop reusing an AI reply for repeated and paraphrased questions."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT message FROM messages WHERE id = %s AND sender = 'bot'", (message_id,))
+        row = c.fetchone()
+        if not row:
+            return jsonify({"error": "AI message not found"}), 404
+        response_cache.reject_answer(redis_client, row['message'])
+        logger.info(f"AI answer {message_id} rejected by {current_user.username}")
+        return jsonify({"success": True})
+    except Exception as e:
+        logger.error(f"Failed to reject AI answer {message_id}: {str(e)}", exc_info=True)
+        return jsonify({"error": "Failed to reject answer"}), 500
+    finally:
+        if conn:
+            release_db_connection(conn)
+
 @app.route('/api/ai/toggle/<int:convo_id>', methods=['POST'])
 def toggle_ai(convo_id):
     conn = None
@@ -621,6 +703,7 @@ def toggle_ai(convo_id):
             (new_status, convo_id)
         )
         conn.commit()
+        settings_service.invalidate(settings_service.conversation_ai_key(convo_id))
         
         status_text = "enabled" if new_status == 1 else "disabled"
         logger.info(f"AI {status_text} for conversation {convo_id} by user {current_user.username}")
@@ -657,9 +740,8 @@ def toggle_global_ai():
         )
         conn.commit()
         
-        # Clear cache
-        if "ai_enabled" in settings_cache:
-            del settings_cache["ai_enabled"]
+        # Drop the cached flag in every web and worker process
+        settings_service.invalidate(settings_service.GLOBAL_AI_ENABLED)
         
         status_text = "enabled" if new_value == "1" else "disabled"
         logger.info(f"Global AI {status_text} by user {current_user.username}")
@@ -691,9 +773,10 @@ def _send_agent_message(convo_id, message, username):
 
         # Log the message from the agent (human)
         timestamp = datetime.now(timezone.utc).isoformat()
+        token_count = token_budget.count_tokens(message)
         c.execute(
-            "INSERT INTO messages (convo_id, username, message, sender, timestamp) VALUES (%s, %s, %s, %s, %s) RETURNING id",
-            (convo_id, username, message, "agent", timestamp)
+            "INSERT INTO messages (convo_id, username, message, sender, timestamp, token_count) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id",
+            (convo_id, username, message, "agent", timestamp, token_count)
         )
         message_id = c.fetchone()['id']
 
@@ -703,6 +786,7 @@ def _send_agent_message(convo_id, message, username):
             (timestamp, convo_id)
         )
         conn.commit()
+        context_cache.append_message(convo_id, "agent", message, token_count)
 
         # Broadcast the message via SocketIO
         socketio.emit('new_message', {
@@ -725,7 +809,8 @@ def _send_agent_message(convo_id, message, username):
                         conversation['chat_id'],
                         message,
                         f"Agent: {username}"
-                    ]
+                    ],
+                    kwargs={'message_id': message_id}
                 )
                 logger.info(f"Message forwarded to WhatsApp for {conversation['chat_id']}")
             except Exception as e:
@@ -765,6 +850,89 @@ def send_message():
     else:
         return jsonify({"error": result}), status_code
 
+# --- TWILIO WEBHOOKS ---
+# Twilio retries webhooks that are slow to answer, so these only validate,
+# enqueue and acknowledge; nothing here touches Postgres.
+twilio_validator = RequestValidator(TWILIO_AUTH_TOKEN)
+EMPTY_TWIML = '<?xml version="1.0" encoding="UTF-8"?><Response></Response>'
+
+def _valid_twilio_request():
+    # request.url reflects the public https URL thanks to ProxyFix
+    signature = request.headers.get('X-Twilio-Signature', '')
+    return twilio_validator.validate(request.url, request.form, signature)
+
+@app.route('/webhook/whatsapp', methods=['POST'])
+def whatsapp_webhook():
+    """Inbound WhatsApp messages from Twilio."""
+    if not _valid_twilio_request():
+        logger.warning(f"Rejected WhatsApp webhook with invalid Twilio signature from {request.remote_addr}")
+        return Response("Invalid signature", status=403)
+
+    message_sid = request.form.get('MessageSid')
+    from_number = request.form.get('From', '').replace('whatsapp:', '', 1)
+    body = request.form.get('Body', '').strip()
+    if not message_sid or not from_number or not body:
+        # Media-only or malformed messages: acknowledge so Twilio doesn't retry
+        logger.warning(f"Ignoring WhatsApp webhook without sender/body (MessageSid={message_sid})")
+        return Response(EMPTY_TWIML, mimetype='text/xml')
+
+    try:
+        celery_app.send_task(
+            'tasks.process_incoming_message',
+            args=[
+                from_number,  # from_number
+                from_number,  # chat_id
+                body,
+                datetime.now(timezone.utc).isoformat(),
+                'whatsapp'  # channel
+            ],
+            kwargs={'message_key': message_sid}
+        )
+    except Exception as e:
+        # Let Twilio retry; the MessageSid makes the redelivery idempotent
+        logger.error(f"Failed to queue WhatsApp message {message_sid}: {e}", exc_info=True)
+        return Response(EMPTY_TWIML, status=503, mimetype='text/xml')
+
+    logger.info(f"WhatsApp message {message_sid} from {from_number} queued for processing.")
+    return Response(EMPTY_TWIML, mimetype='text/xml')
+
+@app.route('/webhook/whatsapp/status', methods=['POST'])
+def whatsapp_status_webhook():
+    """
+    Twilio delivery-status callbacks for outbound messages. Each callback is
+    buffered in Redis and applied in batches by delivery_status.run_flusher.
+    """
+    if not _valid_twilio_request():
+        logger.warning(f"Rejected status callback with invalid Twilio signature from {request.remote_addr}")
+        return Response("Invalid signature", status=403)
+
+    # message_id is our messages.id, set on the StatusCallback URL when sending
+    message_id = request.args.get('message_id', '')
+    status = request.form.get('MessageStatus', '')
+    if not message_id.isdigit() or not delivery_status.is_known_status(status):
+        logger.debug(f"Ignoring status callback {status!r} for message_id={message_id!r}")
+        return Response(status=204)
+
+    try:
+        delivery_status.buffer_status(redis_client, message_id, status)
+    except Exception as e:
+        logger.error(f"Failed to buffer status {status} for message {message_id}: {e}", exc_info=True)
+        return Response(status=503)
+    return Response(status=204)
+
+# One flusher per web process; the Redis drain is atomic, so they don't overlap
+socketio.start_background_task(
+    delivery_status.run_flusher,
+    redis_client,
+    get_db_connection,
+    release_db_connection,
+    socketio.emit,
+    socketio.sleep
+)
+
+# Load the tokenizer now so the first agent message doesn't wait for it
+token_budget.preload()
+
 # Socket.IO events
 @socketio.on('connect')
 def handle_connect():
@@ -786,12 +954,15 @@ def handle_join(data):
     sid = getattr(request, 'sid', None)
     if sid is None:
         sid = request.args.get('sid', 'unknown')
-    if 'convo_id' not in data:
-        logger.warning(f"Join event missing convo_id from {sid}")
+    if 'convo_id' in data:
+        room = f"convo_{data['convo_id']}"
+    elif data.get('chat_id'):
+        # Web guests only know their chat_id; replies and streams for them go here
+        room = f"chat_{data['chat_id']}"
+    else:
+        logger.warning(f"Join event missing convo_id/chat_id from {sid}")
         return
 
-    convo_id = data['convo_id']
-    room = f"convo_{convo_id}"
     join_room(room)
     logger.info(f"Client {sid} joined room: {room}")
 
@@ -816,6 +987,7 @@ def handle_guest_message(data):
         sid = request.args.get('sid', 'unknown')
     message = data.get('message')
     chat_id = data.get('chat_id')  # Persisted chat_id from client-side
+    client_message_id = data.get('client_message_id')  # Idempotency key from the client
 
     if not message:
         logger.warning(f"Guest message from {sid} is empty.")
@@ -839,7 +1011,8 @@ def handle_guest_message(data):
                 message,
                 datetime.now(timezone.utc).isoformat(),
                 'web'  # channel
-            ]
+            ],
+            kwargs={'message_key': client_message_id}
         )
         logger.info(f"Guest message from {chat_id} queued for processing.")
     except Exception as e:
@@ -0,0 +1,129 @@
+"""
+Per-conversation rolling AI context kept in Redis.
+
+Each conversation has a capped list of its most recent turns (JSON
+``{"role": ..., "content": ..., "tokens": ...}`` entries, with the token
+count used for history packing) so the AI stage can build the
+OpenAI messages list without reading Postgres. Appends only touch lists that
+already exist (RPUSHX), so a missing list always means "not cached" and the
+caller repopulates it from the database.
+
+An append that lands while a miss is being filled finds no list and is
+lost, so every append (and invalidation) also bumps a per-conversation
+version. Callers take version() before reading the database, and populate()
+writes nothing if the version moved in the meantime; the next read then
+misses again and loads the newer window.
+"""
+
+import os
+import json
+import logging
+
+import redis
+
+import token_budget
+from ai_helpers import AI_HISTORY_WINDOW
+
+logger = logging.getLogger("chat_server")
+
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", "86400"))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "10"))
+
+redis_client = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
+    os.getenv('REDIS_URL', 'redis://red-cvfhn5nnoe9s73bhmct0:6379'),
+    decode_responses=True,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=10
+))
+
+
+def _key(convo_id):
+    return f"ai_context:{convo_id}"
+
+
+def _version_key(convo_id):
+    return f"ai_context_version:{convo_id}"
+
+
+def role_for_sender(sender):
+    return "user" if sender == "user" else "assistant"
+
+
+def get_context(convo_id):
+    """Return the cached turns oldest-first, or None on a miss."""
+    try:
+        entries = redis_client.lrange(_key(convo_id), 0, -1)
+    except redis.RedisError as e:
+        logger.warning(f"Context cache read failed for convo_id {convo_id}: {e}")
+        return None
+    if not entries:
+        return None
+    return [json.loads(entry) for entry in entries]
+
+
+def version(convo_id):
+    """The conversation's context version; take it before reading turns for populate()."""
+    try:
+        return redis_client.get(_version_key(convo_id)) or "0"
+    except redis.RedisError as e:
+        logger.warning(f"Context cache version read failed for convo_id {convo_id}: {e}")
+        return None
+
+
+def populate(convo_id, conversation_history, expected_version):
+    """Replace the cached context with turns loaded from the database, unless a turn was added since expected_version."""
+    if expected_version is None:
+        return
+    key = _key(convo_id)
+    version_key = _version_key(convo_id)
+    entries = [json.dumps(turn) for turn in conversation_history[-AI_HISTORY_WINDOW:]]
+    try:
+        with redis_client.pipeline(transaction=True) as pipe:
+            pipe.watch(version_key)
+            if (pipe.get(version_key) or "0") != expected_version:
+                logger.debug(f"Context for convo_id {convo_id} changed while loading; not caching it")
+                return
+            pipe.multi()
+            pipe.delete(key)
+            if entries:
+                pipe.rpush(key, *entries)
+                pipe.expire(key, CONTEXT_CACHE_TTL)
+            pipe.execute()
+    except redis.WatchError:
+        logger.debug(f"Context for convo_id {convo_id} changed while caching; not caching it")
+    except redis.RedisError as e:
+        logger.warning(f"Context cache populate failed for convo_id {convo_id}: {e}")
+
+
+def _bump_version(pipe, convo_id):
+    pipe.incr(_version_key(convo_id))
+    pipe.expire(_version_key(convo_id), CONTEXT_CACHE_TTL)
+
+
+def append_message(convo_id, sender, content, tokens=None):
+    """Append a turn to an already-cached context and trim it to the AI window."""
+    key = _key(convo_id)
+    if tokens is None:
+        tokens = token_budget.count_tokens(content)
+    entry = json.dumps({"role": role_for_sender(sender), "content": content, "tokens": tokens})
+    try:
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.rpushx(key, entry)
+        pipe.ltrim(key, -AI_HISTORY_WINDOW, -1)
+        pipe.expire(key, CONTEXT_CACHE_TTL)
+        _bump_version(pipe, convo_id)
+        pipe.execute()
+    except redis.RedisError as e:
+        # A cache that silently missed a turn is worse than no cache
+        logger.warning(f"Context cache append failed for convo_id {convo_id}, invalidating: {e}")
+        invalidate(convo_id)
+
+
+def invalidate(convo_id):
+    try:
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.delete(_key(convo_id))
+        _bump_version(pipe, convo_id)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.error(f"Context cache invalidate failed for convo_id {convo_id}: {e}")
@@ -0,0 +1,130 @@
+"""
+Batched ingestion of Twilio delivery-status callbacks.
+
+Status callbacks (queued, sent, delivered, read, ...) are Twilio's
+highest-volume traffic, several per outbound message. The webhook only
+appends each callback to a Redis list; a background flusher in the web
+process drains up to STATUS_FLUSH_MAX_ROWS entries every
+STATUS_FLUSH_INTERVAL seconds and applies them with one UPDATE ... FROM
+(VALUES ...) and one commit.
+
+Callbacks can arrive out of order, so a status only replaces one that is
+earlier in STATUS_ORDER: a late "delivered" never overwrites "read".
+"""
+
+import os
+import json
+import time
+import logging
+from datetime import datetime, timezone
+
+from psycopg2.extras import execute_values
+
+import metrics
+
+logger = logging.getLogger("chat_server")
+
+STATUS_BUFFER_KEY = "whatsapp:status_buffer"
+STATUS_FLUSH_INTERVAL = float(os.getenv("STATUS_FLUSH_INTERVAL", "2"))
+STATUS_FLUSH_MAX_ROWS = int(os.getenv("STATUS_FLUSH_MAX_ROWS", "1000"))
+
+STATUS_ORDER = ("accepted", "queued", "sending", "sent", "undelivered", "failed", "delivered", "read")
+_STATUS_RANK = {status: rank for rank, status in enumerate(STATUS_ORDER)}
+
+_STATUS_ARRAY = "ARRAY[%s]::varchar[]" % ", ".join(f"'{s}'" for s in STATUS_ORDER)
+
+UPDATE_STATUS_SQL = f"""
+    UPDATE messages AS m
+    SET delivery_status = v.status, delivery_updated_at = v.updated_at
+    FROM (VALUES %s) AS v(id, status, updated_at)
+    WHERE m.id = v.id
+      AND COALESCE(array_position({_STATUS_ARRAY}, m.delivery_status), 0)
+          < array_position({_STATUS_ARRAY}, v.status)
+    RETURNING m.id, m.convo_id, m.delivery_status
+"""
+
+
+def is_known_status(status):
+    return status in _STATUS_RANK
+
+
+def buffer_status(redis_client, message_id, status):
+    """Queue one status callback for the next batched flush."""
+    redis_client.rpush(STATUS_BUFFER_KEY, json.dumps({
+        "message_id": int(message_id),
+        "status": status,
+        "ts": datetime.now(timezone.utc).isoformat()
+    }))
+    metrics.incr("delivery_status.buffered")
+
+
+def _drain(redis_client):
+    # LRANGE + LTRIM in one MULTI so concurrent flushers never take the same entries
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.lrange(STATUS_BUFFER_KEY, 0, STATUS_FLUSH_MAX_ROWS - 1)
+    pipe.ltrim(STATUS_BUFFER_KEY, STATUS_FLUSH_MAX_ROWS, -1)
+    entries, _ = pipe.execute()
+    return entries
+
+
+def _collapse(entries):
+    """Keep only the furthest-along status per message."""
+    latest = {}
+    for raw in entries:
+        try:
+            entry = json.loads(raw)
+        except ValueError:
+            continue
+        current = latest.get(entry["message_id"])
+        if current is None or _STATUS_RANK[entry["status"]] > _STATUS_RANK[current["status"]]:
+            latest[entry["message_id"]] = entry
+    return [(e["message_id"], e["status"], e["ts"]) for e in latest.values()]
+
+
+def flush_status_updates(redis_client, get_connection, release_connection):
+    """
+    Apply buffered callbacks in one batched UPDATE. Returns the rows whose
+    status changed as (message_id, convo_id, delivery_status) tuples.
+    """
+    entries = _drain(redis_client)
+    if not entries:
+        return []
+    rows = _collapse(entries)
+    start = time.monotonic()
+    conn = None
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        updated = execute_values(
+            c, UPDATE_STATUS_SQL, rows,
+            template="(%s::integer, %s::varchar, %s::timestamptz)",
+            page_size=len(rows), fetch=True
+        )
+        conn.commit()
+    except Exception:
+        # Put the entries back so the next flush retries them
+        redis_client.rpush(STATUS_BUFFER_KEY, *entries)
+        if conn and not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            release_connection(conn)
+    metrics.observe("delivery_status.batch_rows", len(rows))
+    metrics.observe("delivery_status.flush_ms", (time.monotonic() - start) * 1000)
+    return [(row[0], row[1], row[2]) for row in updated]
+
+
+def run_flusher(redis_client, get_connection, release_connection, emit, sleep=time.sleep):
+    """Flush forever, emitting a delivery_status event for every changed message."""
+    while True:
+        sleep(STATUS_FLUSH_INTERVAL)
+        try:
+            for message_id, convo_id, status in flush_status_updates(redis_client, get_connection, release_connection):
+                emit('delivery_status', {
+                    'id': message_id,
+                    'convo_id': convo_id,
+                    'delivery_status': status
+                }, to=f"convo_{convo_id}")
+        except Exception as e:
+            logger.error(f"❌ Delivery status flush failed: {str(e)}", exc_info=True)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Fake Twilio Messages API for offline WhatsApp sender throughput tests.
+
+The fake accepts POST /2010-04-01/Accounts/<sid>/Messages.json, simulates
+network latency and enforces a per-sender rate limit with 429 + Retry-After
+like the real API. The bench pushes messages through whatsapp_sender against
+it (a local Redis is needed for the shared token bucket).
+
+Usage:
+    python fake_twilio.py serve [--port 8099] [--rate 25] [--latency-ms 80]
+    TWILIO_API_BASE=http://localhost:8099 python fake_twilio.py bench [--count 500]
+"""
+
+import os
+import sys
+import time
+import uuid
+import argparse
+import logging
+import threading
+from collections import Counter
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("fake_twilio")
+
+
+def create_app(rate, latency_ms):
+    from flask import Flask, request, jsonify
+
+    app = Flask(__name__)
+    lock = threading.Lock()
+    buckets = {}
+    stats = Counter()
+
+    def take_token(sender):
+        now = time.monotonic()
+        with lock:
+            tokens, last = buckets.get(sender, (rate, now))
+            tokens = min(rate, tokens + (now - last) * rate)
+            if tokens < 1:
+                buckets[sender] = (tokens, now)
+                return False
+            buckets[sender] = (tokens - 1, now)
+            return True
+
+    @app.route('/2010-04-01/Accounts/<account_sid>/Messages.json', methods=['POST'])
+    def create_message(account_sid):
+        time.sleep(latency_ms / 1000)
+        sender = request.form.get('From', '')
+        if not take_token(sender):
+            stats['rate_limited'] += 1
+            response = jsonify({"code": 20429, "message": "Too Many Requests", "status": 429})
+            response.status_code = 429
+            response.headers['Retry-After'] = '1'
+            return response
+        stats['accepted'] += 1
+        return jsonify({
+            "sid": f"SM{uuid.uuid4().hex}",
+            "account_sid": account_sid,
+            "from": sender,
+            "to": request.form.get('To'),
+            "body": request.form.get('Body'),
+            "status": "queued"
+        }), 201
+
+    @app.route('/stats', methods=['GET'])
+    def get_stats():
+        return jsonify(dict(stats))
+
+    return app
+
+
+def run_bench(count, to_number):
+    import redis
+    from whatsapp_sender import WhatsAppSender, TwilioRateLimited
+
+    redis_client = redis.Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379/0'))
+    sender = WhatsAppSender(redis_client, "ACfake", "fake-token", os.getenv("TWILIO_WHATSAPP_NUMBER", "+10000000000"))
+
+    pending = [(to_number, f"Bench message {i}") for i in range(count)]
+    rate_limited = 0
+    start = time.time()
+    while pending:
+        results = sender.send_many(pending)
+        retry = []
+        for message, result in zip(pending, results):
+            if isinstance(result, TwilioRateLimited):
+                rate_limited += 1
+                retry.append(message)
+            elif isinstance(result, Exception):
+                logger.error(f"Send failed: {result}")
+        if retry:
+            time.sleep(max(r.retry_after for r in results if isinstance(r, TwilioRateLimited)))
+        pending = retry
+    elapsed = time.time() - start
+    logger.info(f"Sent {count} messages in {elapsed:.2f}s ({count / elapsed:.1f} msg/s), {rate_limited} rate-limited attempts")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Twilio Messages API and WhatsApp sender bench")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser("serve", help="Run the fake Twilio API")
+    serve.add_argument("--port", type=int, default=8099)
+    serve.add_argument("--rate", type=float, default=25, help="Messages/second allowed per sender")
+    serve.add_argument("--latency-ms", type=float, default=80, help="Simulated API latency")
+
+    bench = subparsers.add_parser("bench", help="Send messages through whatsapp_sender")
+    bench.add_argument("--count", type=int, default=500)
+    bench.add_argument("--to", default="+15550000000")
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        create_app(args.rate, args.latency_ms).run(host="127.0.0.1", port=args.port, threaded=True)
+    else:
+        if not os.getenv("TWILIO_API_BASE"):
+            logger.error("Set TWILIO_API_BASE to the fake server, e.g. http://localhost:8099")
+            sys.exit(1)
+        run_bench(args.count, args.to)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+"""
+Knowledge base built from qa_reference.txt, with BM25 retrieval.
+
+The reference document is split on its **Heading** lines, and then on blank
+lines within a heading, so every Q&A pair, policy list or example
+conversation becomes its own section. Two kinds of text are treated
+differently:
+
+- The preamble and any "Instructions..." heading are guidance for the model,
+  not facts. They are returned as ``instructions`` and always sent.
+- The first KB_CORE_SECTIONS sections (business information, rooms,
+  amenities) are ``core_sections``, sent with every request as part of the
+  cacheable prompt prefix (see prompt_builder).
+- Every other section is indexed with BM25. A request only includes the
+  KB_TOP_K sections that best match the guest's question, not the whole
+  16 KB document.
+
+Sections written as "Q (English): ... / A (Spanish): ..." pairs are also
+parsed into ``faq``, so load shedding can answer a guest's question with the
+stored answer of the current version without calling the model
+(``faq_answer``).
+
+``version`` is a hash of the document text. Caches of AI answers key on it
+so that editing the document invalidates them.
+
+Versioned snapshots of the document are kept in Redis (kb:snapshot:<version>,
+with kb:current naming the live one), so prices can be changed without a
+redeploy: publish() stores a new snapshot and announces it on KB_CHANNEL.
+Every process keeps one parsed and indexed copy in memory. A background
+listener builds the new version next to the old one and then swaps the
+reference, so a request never sees a half-built index. A process also
+re-checks kb:current every KB_POLL_SECONDS in case it missed an
+announcement.
+
+On startup qa_reference.txt is published if it differs from the file that
+was last published, so a deploy with an edited file still takes effect.
+"""
+
+import os
+import re
+import math
+import time
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import Counter
+
+import redis
+
+import metrics
+
+logger = logging.getLogger("chat_server")
+
+KNOWLEDGE_BASE_PATH = os.getenv("KNOWLEDGE_BASE_PATH", "qa_reference.txt")
+KB_TOP_K = int(os.getenv("KB_TOP_K", "3"))
+KB_CORE_SECTIONS = int(os.getenv("KB_CORE_SECTIONS", "3"))
+KB_POLL_SECONDS = float(os.getenv("KB_POLL_SECONDS", "60"))
+KB_CHANNEL = os.getenv("KB_CHANNEL", "kb:updated")
+KB_SNAPSHOTS_KEPT = int(os.getenv("KB_SNAPSHOTS_KEPT", "5"))
+# Share of a message's terms a Q&A pair's questions must cover to answer it
+KB_FAQ_MIN_COVERAGE = float(os.getenv("KB_FAQ_MIN_COVERAGE", "0.75"))
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Function words only: "in"/"out" and the like carry the meaning of hotel questions
+FUNCTION_WORDS = frozenset("""
+    a an the is are am be was were do does did can could would will shall should may might
+    i me my we our you your it its this that these those there here what when where which who
+    how to of on at for from with about and or please thanks thank tell know want like just much
+    el la los las un una es son esta estan de del al a en para por con y o que como cuando donde
+    cual quien me mi mis nos nuestro su sus usted ustedes se lo le les puedo puede pueden
+    quiero quisiera saber favor gracias hay tiene tienen
+""".split())
+
+KB_CURRENT_KEY = "kb:current"
+KB_FILE_VERSION_KEY = "kb:file_version"
+KB_VERSIONS_KEY = "kb:versions"
+KB_SNAPSHOT_PREFIX = "kb:snapshot:"
+
+redis_client = redis.Redis.from_url(
+    os.getenv('REDIS_URL', 'redis://red-cvfhn5nnoe9s73bhmct0:6379'),
+    decode_responses=True
+)
+
+_HEADING_RE = re.compile(r"^\*\*(.+?)\*\*\s*$")
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_QA_LINE_RE = re.compile(r"^([QA]) \((\w+)\):\s*(.+)$")
+_QA_LANGUAGES = {"english": "en", "spanish": "es"}
+
+
+def tokenize(text):
+    """Lowercased, accent-folded content-word tokens with a plural "s" stripped."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    tokens = []
+    for word in _TOKEN_RE.findall(text):
+        if len(word) < 2 or word in FUNCTION_WORDS:
+            continue
+        if len(word) > 3 and word.endswith("s"):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+def split_sections(text):
+    """Return (instructions, sections) where each section is 'Heading\\nbody'."""
+    instructions = []
+    sections = []
+    heading = None
+    seen_title = False
+    block = []
+
+    def close_block():
+        body = "\n".join(block).strip()
+        block.clear()
+        if not body:
+            return
+        if heading is None or heading.lower().startswith("instructions"):
+            instructions.append(f"{heading}\n{body}" if heading else body)
+        else:
+            sections.append(f"{heading}\n{body}")
+
+    for line in text.splitlines():
+        match = _HEADING_RE.match(line.strip())
+        if match:
+            close_block()
+            # The first heading is the document title; the preamble under it is guidance
+            heading = match.group(1).strip() if seen_title else None
+            seen_title = True
+            continue
+        if not line.strip():
+            close_block()
+            continue
+        block.append(line)
+    close_block()
+    return "\n\n".join(instructions), sections
+
+
+def parse_faq(section):
+    """(terms of its questions, {language: answer}) of a Q&A section, or None if it isn't one."""
+    terms = set()
+    answers = {}
+    for line in section.splitlines():
+        match = _QA_LINE_RE.match(line.strip())
+        if not match:
+            continue
+        kind, language, text = match.groups()
+        language = _QA_LANGUAGES.get(language.lower(), language.lower())
+        if kind == "Q":
+            terms.update(tokenize(text))
+        else:
+            answers[language] = text.strip()
+    if not terms or not answers:
+        return None
+    return frozenset(terms), answers
+
+
+class BM25Index:
+    """Okapi BM25 over a fixed list of documents."""
+
+    def __init__(self, documents):
+        self._postings = {}
+        self._lengths = []
+        for doc_id, document in enumerate(documents):
+            counts = Counter(tokenize(document))
+            self._lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                self._postings.setdefault(term, []).append((doc_id, tf))
+        count = len(documents)
+        self._avg_length = (sum(self._lengths) / count) if count else 0.0
+        self._idf = {
+            term: math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self._postings.items()
+        }
+
+    def search(self, query, k):
+        """Return up to k (doc_id, score) pairs, best first; only documents sharing a term."""
+        scores = {}
+        for term in set(tokenize(query)):
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for doc_id, tf in self._postings[term]:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[doc_id] / self._avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+class KnowledgeBase:
+    """Instructions and core facts plus a BM25-searchable list of reference sections."""
+
+    def __init__(self, text):
+        self.version = version_of(text)
+        self.instructions, sections = split_sections(text)
+        self.core_sections = sections[:KB_CORE_SECTIONS]
+        self.sections = sections[KB_CORE_SECTIONS:]
+        self._index = BM25Index(self.sections)
+        self.faq = [pair for pair in map(parse_faq, sections) if pair]
+
+    def search(self, query, k=KB_TOP_K):
+        """Return up to k non-core sections relevant to the query, best first."""
+        start = time.monotonic()
+        results = [self.sections[doc_id] for doc_id, _ in self._index.search(query, k)]
+        metrics.observe("kb.retrieval_ms", (time.monotonic() - start) * 1000)
+        return results
+
+    def faq_answer(self, question, language):
+        """The stored answer of the one Q&A pair that clearly matches question, or None."""
+        terms = set(tokenize(question))
+        if not terms:
+            return None
+        best, best_score, runner_up = None, 0.0, 0.0
+        for question_terms, answers in self.faq:
+            score = len(terms & question_terms) / len(terms)
+            if score > best_score:
+                best, best_score, runner_up = answers, score, best_score
+            elif score > runner_up:
+                runner_up = score
+        # A message that matches two pairs equally well asks something else
+        if best is None or best_score < KB_FAQ_MIN_COVERAGE or best_score == runner_up:
+            return None
+        return best.get(language) or best.get("en")
+
+
+_knowledge_base = None
+_load_lock = threading.Lock()
+_listener_pid = None
+_checked_at = 0.0
+
+
+def version_of(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+
+def _read_file(path=KNOWLEDGE_BASE_PATH):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError as e:
+        logger.warning(f"⚠️ {path} not found or failed to load: {e}")
+        return None
+
+
+def publish(text, file_version=None):
+    """Store text as a new snapshot, make it current and tell every process. Returns its version."""
+    version = version_of(text)
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.set(KB_SNAPSHOT_PREFIX + version, text)
+    pipe.set(KB_CURRENT_KEY, version)
+    if file_version:
+        pipe.set(KB_FILE_VERSION_KEY, file_version)
+    pipe.lrem(KB_VERSIONS_KEY, 0, version)
+    pipe.lpush(KB_VERSIONS_KEY, version)
+    pipe.lrange(KB_VERSIONS_KEY, KB_SNAPSHOTS_KEPT, -1)
+    pipe.ltrim(KB_VERSIONS_KEY, 0, KB_SNAPSHOTS_KEPT - 1)
+    expired = pipe.execute()[-2]
+    if expired:
+        redis_client.delete(*(KB_SNAPSHOT_PREFIX + v for v in expired))
+    redis_client.publish(KB_CHANNEL, version)
+    logger.info(f"✅ Published knowledge base version {version}")
+    return version
+
+
+def _seed_from_file():
+    """Publish qa_reference.txt if it changed since it was last published."""
+    text = _read_file()
+    if text is None:
+        return
+    file_version = version_of(text)
+    if redis_client.get(KB_FILE_VERSION_KEY) != file_version:
+        publish(text, file_version=file_version)
+
+
+def _sync():
+    """Swap in the current Redis version if this process has another one."""
+    global _knowledge_base
+    version = redis_client.get(KB_CURRENT_KEY)
+    if version is None or (_knowledge_base is not None and _knowledge_base.version == version):
+        return
+    text = redis_client.get(KB_SNAPSHOT_PREFIX + version)
+    if text is None:
+        logger.error(f"❌ Knowledge base snapshot {version} is missing; keeping the current one")
+        return
+    start = time.monotonic()
+    kb = KnowledgeBase(text)
+    _knowledge_base = kb
+    metrics.incr("kb.reloads")
+    logger.info(f"✅ Knowledge base {kb.version} indexed in {(time.monotonic() - start) * 1000:.1f}ms: {len(kb.core_sections)} core + {len(kb.sections)} indexed sections")
+
+
+def _initial_load():
+    try:
+        _seed_from_file()
+        _sync()
+    except redis.RedisError as e:
+        logger.warning(f"⚠️ Knowledge base store unavailable, using {KNOWLEDGE_BASE_PATH}: {e}")
+    if _knowledge_base is None:
+        return KnowledgeBase(_read_file() or "")
+    return _knowledge_base
+
+
+def preload():
+    """
+    Load and index the current version without starting the update listener.
+    For a prefork parent: a listener thread holding _load_lock at fork time
+    would leave the children with a lock nobody releases. Each process starts
+    its own listener on its first get().
+    """
+    global _knowledge_base, _checked_at
+    if _knowledge_base is None:
+        with _load_lock:
+            if _knowledge_base is None:
+                _knowledge_base = _initial_load()
+                _checked_at = time.monotonic()
+    return _knowledge_base
+
+
+def get():
+    """The process's current knowledge base; indexed on first use, swapped on new versions."""
+    global _checked_at
+    _ensure_listener()
+    if _knowledge_base is None:
+        preload()
+    elif time.monotonic() - _checked_at > KB_POLL_SECONDS:
+        _checked_at = time.monotonic()
+        try:
+            with _load_lock:
+                _sync()
+        except redis.RedisError as e:
+            logger.warning(f"Knowledge base version check failed: {e}")
+    return _knowledge_base
+
+
+def current_version():
+    return get().version
+
+
+def _ensure_listener():
+    """Start this process's version listener (once per pid, so forked workers get their own)."""
+    global _listener_pid
+    pid = os.getpid()
+    if _listener_pid != pid:
+        with _load_lock:
+            if _listener_pid != pid:
+                _listener_pid = pid
+                threading.Thread(target=_listen, name="kb-updates", daemon=True).start()
+
+
+def _listen():
+    while True:
+        pubsub = None
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(KB_CHANNEL)
+            for _ in pubsub.listen():
+                with _load_lock:
+                    _sync()
+        except Exception as e:
+            logger.warning(f"Knowledge base listener disconnected: {e}")
+        finally:
+            if pubsub is not None:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+        time.sleep(1)
+
+
+if __name__ == "__main__":
+    # Publish an edited reference document: python knowledge_base.py [path]
+    import sys
+    path = sys.argv[1] if len(sys.argv) > 1 else KNOWLEDGE_BASE_PATH
+    text = _read_file(path)
+    if text is None:
+        sys.exit(1)
+    print(publish(text))
@@ -0,0 +1,182 @@
+"""
+Fast language detection for inbound guest messages.
+
+Most guest messages are short ("hola", "do you have rooms?"), which is where
+langdetect is both slowest relative to the work and nondeterministic. This
+module answers from cheap signals first:
+
+- Unicode script (Cyrillic, Arabic, CJK, ...) decides non-Latin languages.
+- For Latin script, stopword/greeting hits plus language-specific characters
+  (ñ ¿ ¡, ç ã õ, ß ä ö ü, ...) are scored; the best language wins only if it
+  clearly beats the runner-up.
+
+Inconclusive text falls back to langdetect (seeded for determinism) only when
+it is long enough for langdetect to be reliable and the conversation has no
+known language yet. Results are memoized per normalized text and the last
+language seen per conversation is kept in a small in-process LRU.
+
+Switching an existing conversation takes stronger evidence than picking a
+new one's language: a lone "no" or "gracias" from an English guest must not
+turn every later reply Spanish.
+"""
+
+import os
+import re
+import logging
+import unicodedata
+from functools import lru_cache
+
+from cachetools import LRUCache
+from langdetect import DetectorFactory, LangDetectException, detect as langdetect_detect
+from langdetect.detector_factory import init_factory
+
+logger = logging.getLogger("chat_server")
+
+DetectorFactory.seed = 0
+
+DEFAULT_LANGUAGE = "en"
+LANGDETECT_MIN_CHARS = int(os.getenv("LANGDETECT_MIN_CHARS", "20"))
+# Stopword/marker score a short message needs to switch a conversation's language
+LANGUAGE_SWITCH_MIN_SCORE = int(os.getenv("LANGUAGE_SWITCH_MIN_SCORE", "2"))
+
+_STOPWORDS = {
+    "en": """
+        hi hello hey thanks thank you please yes the a an is are was do does did have has
+        what when where which who how why can could would will i me my we our it this that
+        for with from to of in on at and or but no not room rooms available book booking night
+        morning evening good price much any there here""",
+    "es": """
+        hola gracias buenos buenas dias días tardes noches por favor sí si el la los las un una
+        es son está están que qué cuándo cuando dónde donde cómo como cuánto cuanto quiero
+        tienen tiene hay para con del al y o pero no habitación habitaciones disponible reserva
+        reservar noche precio mi mis nosotros yo usted ustedes también muy""",
+    "pt": """
+        olá ola obrigado obrigada bom boa dia tarde noite por favor sim o a os as um uma é são
+        está estão que quando onde como quanto quero têm tem há para com do da e ou mas não
+        quarto quartos disponível reserva reservar noite preço meu minha nós eu você também muito""",
+    "fr": """
+        bonjour bonsoir salut merci oui non le la les un une est sont que quand où comment
+        combien je veux vous avez avez-vous il y a pour avec du des et ou mais pas chambre
+        chambres disponible réservation réserver nuit prix mon ma nous aussi très""",
+    "de": """
+        hallo guten tag morgen abend danke bitte ja nein der die das ein eine ist sind was wann
+        wo wie wieviel ich möchte haben sie gibt es für mit von und oder aber nicht zimmer frei
+        buchen buchung nacht preis mein meine wir auch sehr""",
+    "it": """
+        ciao buongiorno buonasera grazie per favore sì il lo la gli le un una è sono che quando
+        dove come quanto voglio avete c'è con del della e o ma non camera camere disponibile
+        prenotazione prenotare notte prezzo mio mia noi anche molto""",
+}
+STOPWORDS = {lang: frozenset(words.split()) for lang, words in _STOPWORDS.items()}
+
+# Characters that (almost) only one of the Latin-script languages uses
+_MARKER_CHARS = {
+    "es": "ñ¿¡",
+    "pt": "ãõç",
+    "fr": "èêëœçîû",
+    "de": "ßäöü",
+    "it": "ìò",
+}
+_MARKER_WEIGHT = 2
+
+# (first, last, language) code point ranges for script-identified languages
+_SCRIPT_RANGES = (
+    (0x0400, 0x04FF, "ru"),
+    (0x0370, 0x03FF, "el"),
+    (0x0590, 0x05FF, "he"),
+    (0x0600, 0x06FF, "ar"),
+    (0x0900, 0x097F, "hi"),
+    (0x0E00, 0x0E7F, "th"),
+    (0x3040, 0x30FF, "ja"),
+    (0xAC00, 0xD7AF, "ko"),
+    (0x4E00, 0x9FFF, "zh"),
+)
+
+_WORD_RE = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)?", re.UNICODE)
+
+_conversation_languages = LRUCache(maxsize=int(os.getenv("LANGUAGE_CACHE_SIZE", "10000")))
+
+
+def preload():
+    """Load langdetect's profiles now instead of on the first fallback call."""
+    init_factory()
+    detect_fast("hello")
+    logger.info("✅ Language detector preloaded")
+
+
+def _detect_script(text):
+    counts = {}
+    for ch in text:
+        code = ord(ch)
+        if code < 0x0370:
+            continue
+        for first, last, language in _SCRIPT_RANGES:
+            if first <= code <= last:
+                counts[language] = counts.get(language, 0) + 1
+                break
+    if not counts:
+        return None
+    # Kana mixed with kanji is Japanese, not Chinese
+    if counts.get("ja"):
+        return "ja"
+    return max(counts, key=counts.get)
+
+
+@lru_cache(maxsize=4096)
+def _detect_scored(text):
+    """(language, score) for a confident detection, else (None, 0); script matches score highest."""
+    normalized = unicodedata.normalize("NFC", text.strip().lower())
+    if not normalized:
+        return None, 0
+
+    script_language = _detect_script(normalized)
+    if script_language:
+        return script_language, LANGUAGE_SWITCH_MIN_SCORE
+
+    scores = dict.fromkeys(STOPWORDS, 0)
+    for word in _WORD_RE.findall(normalized):
+        for language, words in STOPWORDS.items():
+            if word in words:
+                scores[language] += 1
+    for language, markers in _MARKER_CHARS.items():
+        if any(ch in normalized for ch in markers):
+            scores[language] += _MARKER_WEIGHT
+
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    (best, best_score), (_, runner_up) = ranked[0], ranked[1]
+    if best_score > 0 and best_score > runner_up:
+        return best, best_score
+    return None, 0
+
+
+def detect_fast(text):
+    """Return a confidently detected language code, or None if the text is inconclusive."""
+    return _detect_scored(text)[0]
+
+
+def detect_for_conversation(conversation_key, text):
+    """
+    Detect the language of a message in a conversation.
+    Returns (language, switch_to). language is the confident detection, used
+    for a new conversation (None if inconclusive). switch_to is set only when
+    the evidence is strong enough to replace an existing conversation's
+    language: LANGUAGE_SWITCH_MIN_SCORE signals, or a message of at least
+    LANGDETECT_MIN_CHARS characters.
+    """
+    language, score = _detect_scored(text)
+    long_enough = len(text) >= LANGDETECT_MIN_CHARS
+    if language is None and conversation_key not in _conversation_languages and long_enough:
+        try:
+            language = langdetect_detect(text)
+        except LangDetectException:
+            language = None
+    if language is None:
+        return None, None
+    switch_to = language if (long_enough or score >= LANGUAGE_SWITCH_MIN_SCORE) else None
+    return language, switch_to
+
+
+def remember(conversation_key, language):
+    """Record the language a conversation is currently using."""
+    if language:
+        _conversation_languages[conversation_key] = language
@@ -0,0 +1,111 @@
+"""
+Group-commit writer for message rows.
+
+Concurrent tasks in one worker process (the gevent AI pool keeps hundreds in
+flight) hand their INSERTs to a single background flusher, which writes
+everything that arrived within MESSAGE_BATCH_WINDOW_MS (or up to
+MESSAGE_BATCH_MAX_ROWS rows) as one multi-row INSERT and one commit. Each
+caller blocks until its batch commits and gets its message id back.
+
+Rows are matched to callers through their unique external_id, since
+PostgreSQL doesn't guarantee RETURNING order for multi-row inserts; an
+external_id that already exists returns the existing row's id.
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+from psycopg2.extras import execute_values
+
+import metrics
+
+logger = logging.getLogger("chat_server")
+
+MESSAGE_BATCH_WINDOW_MS = float(os.getenv("MESSAGE_BATCH_WINDOW_MS", "10"))
+MESSAGE_BATCH_MAX_ROWS = int(os.getenv("MESSAGE_BATCH_MAX_ROWS", "100"))
+MESSAGE_WRITE_TIMEOUT = float(os.getenv("MESSAGE_WRITE_TIMEOUT", "30"))
+
+INSERT_MESSAGES_SQL = """
+    INSERT INTO messages (convo_id, username, message, sender, timestamp, external_id, token_count)
+    VALUES %s
+    ON CONFLICT (external_id) DO UPDATE SET external_id = EXCLUDED.external_id
+    RETURNING id, external_id
+"""
+
+
+class MessageBatchWriter:
+    """Batches message INSERTs from concurrent callers into group commits."""
+
+    def __init__(self, get_connection, release_connection):
+        self._get_connection = get_connection
+        self._release_connection = release_connection
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._flusher_pid = None
+
+    def write(self, convo_id, username, message, sender, timestamp, external_id, token_count=None):
+        """Insert one message (external_id is required) and return its id once committed."""
+        if not external_id:
+            raise ValueError("Batched message writes require an external_id")
+        self._ensure_flusher()
+        future = Future()
+        self._queue.put(((convo_id, username, message, sender, timestamp, external_id, token_count), future))
+        return future.result(timeout=MESSAGE_WRITE_TIMEOUT)
+
+    def _ensure_flusher(self):
+        # One flusher per process; a forked child must start its own
+        pid = os.getpid()
+        if self._flusher_pid != pid:
+            with self._lock:
+                if self._flusher_pid != pid:
+                    self._flusher_pid = pid
+                    self._queue = queue.Queue()
+                    threading.Thread(target=self._run, name="message-writer", daemon=True).start()
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + MESSAGE_BATCH_WINDOW_MS / 1000
+        while len(batch) < MESSAGE_BATCH_MAX_ROWS:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            try:
+                self._flush(batch)
+            except Exception as e:
+                logger.error(f"❌ Batched message insert of {len(batch)} rows failed: {str(e)}", exc_info=True)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _flush(self, batch):
+        start = time.monotonic()
+        # The same external_id twice in one statement would make ON CONFLICT
+        # DO UPDATE touch a row twice, so insert each key once
+        rows = list({row[5]: row for row, _ in batch}.values())
+        conn = None
+        try:
+            conn = self._get_connection()
+            c = conn.cursor()
+            inserted = execute_values(c, INSERT_MESSAGES_SQL, rows, page_size=len(rows), fetch=True)
+            conn.commit()
+        finally:
+            self._release_connection(conn)
+
+        ids = {row['external_id']: row['id'] for row in inserted}
+        for row, future in batch:
+            future.set_result(ids[row[5]])
+        metrics.observe("message_writer.batch_rows", len(rows))
+        metrics.observe("message_writer.flush_ms", (time.monotonic() - start) * 1000)
@@ -0,0 +1,145 @@
+"""
+Lightweight cross-process metrics for the web and worker processes.
+
+Counters and timings are accumulated in memory and flushed to Redis hashes
+at most every METRICS_FLUSH_INTERVAL seconds, so recording a sample never
+costs a network round trip on the hot path. Counters are summed across
+processes; gauges are kept per process (``name@host:pid``), in a hash per
+process that expires METRICS_GAUGE_TTL seconds after its last flush and is
+deleted on a clean exit, so processes from earlier deploys drop out.
+"""
+
+import os
+import time
+import socket
+import atexit
+import logging
+import threading
+from collections import defaultdict
+
+import redis
+
+logger = logging.getLogger("chat_server")
+
+METRICS_KEY = os.getenv("METRICS_KEY", "metrics")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+METRICS_GAUGE_TTL = int(os.getenv("METRICS_GAUGE_TTL", "300"))
+
+_redis_client = None
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+_last_flush = time.monotonic()
+
+
+def _get_redis():
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(
+            os.getenv('REDIS_URL', 'redis://red-cvfhn5nnoe9s73bhmct0:6379'),
+            decode_responses=True
+        )
+    return _redis_client
+
+
+def _process_label():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _gauges_key(label):
+    return f"{METRICS_KEY}:gauges:{label}"
+
+
+def incr(name, amount=1):
+    """Increment a cluster-wide counter."""
+    with _lock:
+        _counters[name] += amount
+    _maybe_flush()
+
+
+def observe(name, value):
+    """Record a timing/size sample; exposed as ``name.count``, ``name.sum`` and ``name.avg``."""
+    with _lock:
+        _counters[f"{name}.count"] += 1
+        _counters[f"{name}.sum"] += value
+        max_key = f"{name}.max@{_process_label()}"
+        if value > _gauges.get(max_key, float("-inf")):
+            _gauges[max_key] = value
+    _maybe_flush()
+
+
+def gauge(name, value):
+    """Set a per-process gauge."""
+    with _lock:
+        _gauges[f"{name}@{_process_label()}"] = value
+    _maybe_flush()
+
+
+def _maybe_flush():
+    if time.monotonic() - _last_flush >= METRICS_FLUSH_INTERVAL:
+        flush()
+
+
+def flush():
+    """Push buffered samples to Redis. Failures are logged and the samples dropped."""
+    global _last_flush
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        _counters.clear()
+        _last_flush = time.monotonic()
+    if not counters and not gauges:
+        return
+    try:
+        pipe = _get_redis().pipeline(transaction=False)
+        for name, amount in counters.items():
+            pipe.hincrbyfloat(f"{METRICS_KEY}:counters", name, amount)
+        if gauges:
+            label = _process_label()
+            pipe.hset(_gauges_key(label), mapping=gauges)
+            pipe.expire(_gauges_key(label), METRICS_GAUGE_TTL)
+            pipe.zadd(f"{METRICS_KEY}:processes", {label: time.time()})
+        pipe.execute()
+    except Exception as e:
+        logger.debug(f"Failed to flush metrics: {e}")
+
+
+def snapshot():
+    """Return all flushed counters (with derived averages and hit rates) and gauges."""
+    client = _get_redis()
+    counters = {k: float(v) for k, v in client.hgetall(f"{METRICS_KEY}:counters").items()}
+    for name in list(counters):
+        if name.endswith(".sum"):
+            base = name[:-len(".sum")]
+            count = counters.get(f"{base}.count")
+            if count:
+                counters[f"{base}.avg"] = counters[name] / count
+        elif name.endswith(".hits"):
+            base = name[:-len(".hits")]
+            lookups = counters[name] + counters.get(f"{base}.misses", 0)
+            counters[f"{base}.hit_rate"] = counters[name] / lookups
+    processes_key = f"{METRICS_KEY}:processes"
+    client.zremrangebyscore(processes_key, "-inf", time.time() - METRICS_GAUGE_TTL)
+    pipe = client.pipeline(transaction=False)
+    for label in client.zrange(processes_key, 0, -1):
+        pipe.hgetall(_gauges_key(label))
+    gauges = {}
+    for process_gauges in pipe.execute():
+        gauges.update((k, float(v)) for k, v in process_gauges.items())
+    return {"counters": counters, "gauges": gauges}
+
+
+def retire_process():
+    """Flush, then remove this process's gauges (at exit; prefork children call it on shutdown)."""
+    flush()
+    label = _process_label()
+    try:
+        pipe = _get_redis().pipeline(transaction=False)
+        pipe.delete(_gauges_key(label))
+        pipe.zrem(f"{METRICS_KEY}:processes", label)
+        pipe.execute()
+    except Exception as e:
+        logger.debug(f"Failed to remove process gauges: {e}")
+
+
+atexit.register(retire_process)
@@ -0,0 +1,90 @@
+"""
+Prompt assembly laid out for provider-side prompt caching.
+
+OpenAI reuses the computed prefix of a prompt when a new request starts with
+the same bytes (1024+ tokens), which cuts both latency and input cost. So
+the messages are ordered from most to least shared:
+
+1. System prefix: persona, model instructions, core facts and the reply
+   language. It is identical for every request in one language and
+   knowledge-base version, and is built once per variant and memoized.
+2. Conversation history, which only grows, so a conversation's earlier
+   turns are a shared prefix of its next request.
+3. The reference sections retrieved for this request, last.
+
+Nothing request-specific (timestamps, ids, names) may go into the prefix.
+"""
+
+import os
+import logging
+import threading
+
+import knowledge_base
+
+logger = logging.getLogger("chat_server")
+
+# Prefix variants built at worker startup instead of on the first request
+PROMPT_PRELOAD_LANGUAGES = [l for l in os.getenv("PROMPT_PRELOAD_LANGUAGES", "en,es").split(",") if l]
+
+PERSONA = "You are a helpful assistant for Amapola Resort."
+REFERENCE_HEADER = "Reference information for this question (answer from this; don't invent rates or policies):"
+
+LANGUAGE_NAMES = {
+    "en": "English",
+    "es": "Spanish",
+    "pt": "Portuguese",
+    "fr": "French",
+    "de": "German",
+    "it": "Italian",
+}
+
+_prefixes = {}
+_prefix_version = None
+_lock = threading.Lock()
+
+
+def _build_prefix(kb, language):
+    parts = [PERSONA]
+    if kb.instructions:
+        parts.append(kb.instructions)
+    if kb.core_sections:
+        parts.append("Resort facts:\n\n" + "\n\n".join(kb.core_sections))
+    parts.append(f"Reply in {LANGUAGE_NAMES.get(language, language)}.")
+    return "\n\n".join(parts)
+
+
+def system_prefix(kb, language):
+    """The byte-stable system prompt for a language under kb's version, memoized."""
+    global _prefix_version
+    key = language or "en"
+    prefix = _prefixes.get(key) if _prefix_version == kb.version else None
+    if prefix is None:
+        with _lock:
+            if _prefix_version != kb.version:
+                # Knowledge base swapped: old variants can never be hit again
+                _prefixes.clear()
+                _prefix_version = kb.version
+            prefix = _prefixes.get(key)
+            if prefix is None:
+                prefix = _prefixes[key] = _build_prefix(kb, key)
+    return prefix
+
+
+def preload(kb=None):
+    """Build the prefix variant for each PROMPT_PRELOAD_LANGUAGES language."""
+    kb = kb or knowledge_base.get()
+    for language in PROMPT_PRELOAD_LANGUAGES:
+        system_prefix(kb, language)
+    logger.info(f"✅ Prompt prefixes built for {', '.join(PROMPT_PRELOAD_LANGUAGES)} (knowledge base {kb.version})")
+
+
+def build_messages(kb, language, conversation_history, reference_sections):
+    """OpenAI chat messages: stable prefix, then history, then per-request references."""
+    messages = [{"role": "system", "content": system_prefix(kb, language)}]
+    messages.extend(conversation_history)
+    if reference_sections:
+        messages.append({
+            "role": "system",
+            "content": REFERENCE_HEADER + "\n\n" + "\n\n".join(reference_sections)
+        })
+    return messages
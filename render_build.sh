@@ -4,5 +4,8 @@ set -o errexit
 
 pip install -r requirements.txt
 
+# Fetch the tokenizer encodings so no process downloads them at runtime
+python token_budget.py
+
 # Initialize the database
 python -c 'from chat_server import initialize_database; initialize_database()'
@@ -0,0 +1,71 @@
+"""
+Relays a streamed AI reply to Socket.IO while it is being generated.
+
+get_ai_response calls the stream with the reply text so far after every
+chunk; the stream emits the new text as ``ai_stream_chunk`` events at most
+once per AI_STREAM_EMIT_INTERVAL_MS, so a fast model doesn't turn into one
+event per token. The reply is finalized by the regular ``new_message``
+event, which carries the same stream_id so clients replace the streamed
+bubble with the persisted message.
+
+If OpenAI is retried mid-stream the text restarts; the next chunk is then
+sent with ``reset`` set and the full text, and clients replace what they
+have shown so far.
+"""
+
+import os
+import time
+import logging
+
+import metrics
+
+logger = logging.getLogger("chat_server")
+
+AI_STREAM_EMIT_INTERVAL_MS = float(os.getenv("AI_STREAM_EMIT_INTERVAL_MS", "100"))
+
+
+def stream_id_for(message_id):
+    """Stream id of the reply to a user message; stable across task retries."""
+    return f"reply:{message_id}"
+
+
+class ReplyStream:
+    """Throttled ai_stream_chunk emitter for one reply."""
+
+    def __init__(self, sio, rooms, convo_id, chat_id, stream_id):
+        self._sio = sio
+        self._rooms = rooms
+        self._payload = {'convo_id': convo_id, 'chat_id': chat_id, 'stream_id': stream_id}
+        self._sent = ""
+        self._latest = ""
+        self._last_emit = 0.0
+        self._first_chunk_at = None
+        self._started = time.monotonic()
+
+    def __call__(self, text):
+        self._latest = text
+        if (time.monotonic() - self._last_emit) * 1000 >= AI_STREAM_EMIT_INTERVAL_MS:
+            self._emit()
+
+    def close(self):
+        """Emit whatever text is still pending."""
+        self._emit()
+
+    def _emit(self):
+        text = self._latest
+        if text == self._sent:
+            return
+        reset = not text.startswith(self._sent)
+        chunk = dict(self._payload, delta=text if reset else text[len(self._sent):], reset=reset)
+        try:
+            for room in self._rooms:
+                self._sio.emit('ai_stream_chunk', chunk, room=room)
+        except Exception as e:
+            # Streaming is best effort; the final new_message still delivers the reply
+            logger.warning(f"Failed to emit stream chunk for {self._payload['stream_id']}: {e}")
+            return
+        if self._first_chunk_at is None:
+            self._first_chunk_at = time.monotonic()
+            metrics.observe("ai.stream_first_chunk_ms", (self._first_chunk_at - self._started) * 1000)
+        self._sent = text
+        self._last_emit = time.monotonic()
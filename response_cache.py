@@ -0,0 +1,140 @@
+"""
+Response cache for repeated first-turn guest questions.
+
+Many conversations open with the same question ("what time is check-in?",
+"do you allow pets?"). The answer to a question asked with no prior context
+depends only on the question, the language and the knowledge base, so it
+is cached in Redis under a hash of
+
+    normalized question text + language + knowledge-base version
+
+Normalization lowercases, strips accents, punctuation and a leading
+greeting, and collapses whitespace, so "Hi! What time is check-in?" and
+"what time is check in" share an entry. Entries expire after
+RESPONSE_CACHE_TTL seconds. An index sorted set caps the cache at
+RESPONSE_CACHE_MAX_ENTRIES, evicting the oldest entries first. Changing
+the knowledge base changes the version, which orphans every old entry.
+
+Only context-free questions may use the cache: once the conversation has
+earlier turns, the right answer depends on them.
+
+Cached answers are model output that nobody reviewed before reuse. An agent
+who spots a bad one rejects it (POST /api/ai/reject-answer/<message_id>):
+its hash goes into REJECTED_ANSWERS_KEY, and both this cache and the
+similar-question index treat a rejected answer as a miss from then on.
+"""
+
+import os
+import re
+import hashlib
+import logging
+import unicodedata
+
+import redis
+
+import metrics
+import knowledge_base
+
+logger = logging.getLogger("chat_server")
+
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "5000"))
+# Long messages are rarely repeated verbatim; don't fill the cache with them
+RESPONSE_CACHE_MAX_QUESTION_CHARS = int(os.getenv("RESPONSE_CACHE_MAX_QUESTION_CHARS", "200"))
+
+RESPONSE_KEY_PREFIX = "ai:response:"
+RESPONSE_INDEX_KEY = "ai:response:index"
+REJECTED_ANSWERS_KEY = "ai:response:rejected"
+
+_GREETINGS = ("hi", "hello", "hey", "hola", "buenas", "buenos dias", "buenas tardes",
+              "buenas noches", "good morning", "good afternoon", "good evening", "ola", "bonjour")
+_GREETING_RE = re.compile(r"^(?:%s)\b\s*" % "|".join(re.escape(g) for g in _GREETINGS))
+_NON_WORD_RE = re.compile(r"[^\w\s]+", re.UNICODE)
+_SPACE_RE = re.compile(r"\s+")
+
+# Stores the entry, drops expired entries from the index and trims it to the
+# size bound, atomically
+_store_script = """
+redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('zadd', KEYS[2], ARGV[3], KEYS[1])
+redis.call('zremrangebyscore', KEYS[2], '-inf', tonumber(ARGV[3]) - tonumber(ARGV[2]))
+local excess = redis.call('zcard', KEYS[2]) - tonumber(ARGV[4])
+if excess > 0 then
+    local evicted = redis.call('zrange', KEYS[2], 0, excess - 1)
+    redis.call('zremrangebyrank', KEYS[2], 0, excess - 1)
+    redis.call('del', unpack(evicted))
+end
+return excess > 0 and excess or 0
+"""
+
+
+def normalize_question(text):
+    """Canonical form of a question for cache lookups."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = _NON_WORD_RE.sub(" ", text)
+    text = _SPACE_RE.sub(" ", text).strip()
+    return _GREETING_RE.sub("", text)
+
+
+def _answer_hash(answer):
+    return hashlib.sha1(answer.encode("utf-8")).hexdigest()
+
+
+def reject_answer(redis_client, answer):
+    """Stop reusing answer for any question, in every process."""
+    redis_client.sadd(REJECTED_ANSWERS_KEY, _answer_hash(answer))
+
+
+def is_cacheable(conversation_history, question):
+    """True for a first-turn question: nothing in the context but the question itself."""
+    return len(conversation_history) <= 1 and 0 < len(question) <= RESPONSE_CACHE_MAX_QUESTION_CHARS
+
+
+class ResponseCache:
+    """Redis-backed cache of AI replies to context-free questions."""
+
+    def __init__(self, redis_client):
+        self._redis = redis_client
+        self._store = redis_client.register_script(_store_script)
+
+    @staticmethod
+    def _key(question, language):
+        raw = "\x1f".join((knowledge_base.current_version(), language or "", normalize_question(question)))
+        return RESPONSE_KEY_PREFIX + hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def is_rejected(self, answer):
+        """True if an agent rejected answer; unknown counts as not rejected."""
+        try:
+            return bool(self._redis.sismember(REJECTED_ANSWERS_KEY, _answer_hash(answer)))
+        except redis.RedisError as e:
+            logger.warning(f"Rejected-answer check failed: {e}")
+            return False
+
+    def get(self, question, language):
+        """Return the cached reply, or None on a miss."""
+        key = self._key(question, language)
+        try:
+            reply = self._redis.get(key)
+            if reply is not None and self.is_rejected(reply):
+                self._redis.delete(key)
+                reply = None
+        except redis.RedisError as e:
+            logger.warning(f"Response cache read failed: {e}")
+            reply = None
+        metrics.incr("response_cache.hits" if reply is not None else "response_cache.misses")
+        return reply
+
+    def put(self, question, language, reply):
+        try:
+            now = self._redis.time()[0]
+            evicted = self._store(
+                keys=[self._key(question, language), RESPONSE_INDEX_KEY],
+                args=[reply, RESPONSE_CACHE_TTL, now, RESPONSE_CACHE_MAX_ENTRIES]
+            )
+        except redis.RedisError as e:
+            logger.warning(f"Response cache write failed: {e}")
+            return
+        metrics.incr("response_cache.stores")
+        if evicted:
+            metrics.incr("response_cache.evictions", int(evicted))
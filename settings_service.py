@@ -0,0 +1,139 @@
+"""
+Cluster-wide settings/flags cache shared by the web and Celery processes.
+
+Values (global ``ai_enabled``, per-conversation ``ai_enabled``) are held in
+memory for up to SETTINGS_CACHE_TTL seconds and dropped as soon as any
+process publishes an invalidation on SETTINGS_CHANNEL, so a toggle applies
+everywhere immediately without per-message settings queries. Each process
+runs one background listener; if it loses its subscription the whole cache
+is cleared, since invalidations may have been missed.
+
+A value read before an invalidation but stored after it would be stale for
+a whole TTL. Every invalidation bumps a generation counter, so a value is
+only stored if its key wasn't invalidated since the read started.
+"""
+
+import os
+import time
+import logging
+import threading
+
+import redis
+from cachetools import TTLCache
+
+logger = logging.getLogger("chat_server")
+
+SETTINGS_CACHE_TTL = int(os.getenv("SETTINGS_CACHE_TTL", "600"))
+SETTINGS_CHANNEL = os.getenv("SETTINGS_CHANNEL", "settings:invalidate")
+
+GLOBAL_AI_ENABLED = "ai_enabled"
+_CLEAR_ALL = "*"
+
+redis_client = redis.Redis.from_url(
+    os.getenv('REDIS_URL', 'redis://red-cvfhn5nnoe9s73bhmct0:6379'),
+    decode_responses=True
+)
+
+_cache = TTLCache(maxsize=10000, ttl=SETTINGS_CACHE_TTL)
+_lock = threading.Lock()
+_listener_pid = None
+_listener_ready = threading.Event()
+_generation = 0     # bumped by every invalidation
+_dropped_at = {}    # key -> generation of its last invalidation
+_cleared_at = 0     # generation of the last clear-all
+
+
+def conversation_ai_key(convo_id):
+    return f"convo_ai_enabled:{convo_id}"
+
+
+def generation():
+    """Capture before a read whose result will be passed to prime()."""
+    with _lock:
+        return _generation
+
+
+def _store(key, value, since):
+    # Caller holds _lock; skip values read before key was invalidated
+    if _cleared_at <= since and _dropped_at.get(key, 0) <= since:
+        _cache[key] = value
+
+
+def get(key, loader):
+    """Return the cached value for key, calling loader() to fill a miss."""
+    listening = _ensure_listener()
+    with _lock:
+        if key in _cache:
+            return _cache[key]
+        since = _generation
+    value = loader()
+    # Without a live subscription we can't hear invalidations, so don't cache
+    if listening:
+        with _lock:
+            _store(key, value, since)
+    return value
+
+
+def prime(key, value, since):
+    """Store a value read as a side effect of another query; since is generation() from before that read."""
+    if _ensure_listener():
+        with _lock:
+            _store(key, value, since)
+
+
+def invalidate(key=_CLEAR_ALL):
+    """Drop key in this process and tell every other process to drop it too."""
+    _drop(key)
+    try:
+        redis_client.publish(SETTINGS_CHANNEL, key)
+    except redis.RedisError as e:
+        logger.error(f"Failed to publish settings invalidation for '{key}': {e}")
+
+
+def _drop(key):
+    global _generation, _cleared_at
+    with _lock:
+        _generation += 1
+        if key == _CLEAR_ALL:
+            _cache.clear()
+            _dropped_at.clear()
+            _cleared_at = _generation
+        else:
+            _cache.pop(key, None)
+            _dropped_at[key] = _generation
+
+
+def _ensure_listener():
+    """Start this process's listener (once per pid, so forked workers get their own)."""
+    global _listener_pid
+    pid = os.getpid()
+    if _listener_pid != pid:
+        with _lock:
+            if _listener_pid != pid:
+                _listener_pid = pid
+                _listener_ready.clear()
+                _cache.clear()
+                threading.Thread(target=_listen, name="settings-invalidation", daemon=True).start()
+    return _listener_ready.is_set()
+
+
+def _listen():
+    while True:
+        pubsub = None
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(SETTINGS_CHANNEL)
+            _listener_ready.set()
+            for message in pubsub.listen():
+                _drop(message["data"])
+        except Exception as e:
+            logger.warning(f"Settings invalidation listener disconnected: {e}")
+        finally:
+            _listener_ready.clear()
+            _drop(_CLEAR_ALL)
+            if pubsub is not None:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+        time.sleep(1)
@@ -0,0 +1,268 @@
+"""
+MinHash LSH index of answered first-turn questions, for reusing answers to
+paraphrases ("what time is check in" / "when can I check in?").
+
+A question is reduced to its content words (the normalized text of
+response_cache minus function words, with plural "s" stripped). Each
+question gets a MinHash signature of SIMILAR_MINHASH_PERMUTATIONS values,
+split into bands for LSH bucketing. A lookup collects the candidates that
+share a band with the new question, then checks the exact Jaccard
+similarity of the word sets. The best candidate at or above
+SIMILAR_QUESTION_THRESHOLD is the answer. There is one index per language.
+
+Numbers and negations change the answer while barely moving the Jaccard
+score ("junior suite for 2 nights" / "for 3 nights", "is breakfast
+included" / "is breakfast not included"), so a candidate is only
+considered if those terms match exactly.
+
+The index lives in process memory. Additions are appended to a Redis
+stream per knowledge-base version (SIMILAR_JOURNAL_PREFIX + version),
+which serves three purposes:
+
+- A restarted or redeployed worker replays the journal to rebuild its index.
+- Every process, on any host, reads the entries added since its last read
+  every SIMILAR_INDEX_REFRESH_SECONDS.
+- A hot-reloaded knowledge base starts a new, empty journal; the old one
+  expires after SIMILAR_JOURNAL_TTL.
+
+Each language keeps at most SIMILAR_INDEX_MAX_ENTRIES questions, oldest
+evicted first. Redis trims the journal to about twice that many entries.
+
+Answers are indexed as soon as the model produces them (fallback replies
+excepted), not after a review: waiting for an agent to approve each one
+would leave the index empty exactly when it matters, under load. Instead
+an agent can reject a bad answer (see response_cache.reject_answer); the
+caller checks hits against the rejected set and discard()s them.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import redis
+
+import metrics
+import knowledge_base
+from knowledge_base import FUNCTION_WORDS
+from response_cache import normalize_question
+
+logger = logging.getLogger("chat_server")
+
+SIMILAR_QUESTION_THRESHOLD = float(os.getenv("SIMILAR_QUESTION_THRESHOLD", "0.65"))
+SIMILAR_INDEX_MAX_ENTRIES = int(os.getenv("SIMILAR_INDEX_MAX_ENTRIES", "5000"))
+SIMILAR_INDEX_REFRESH_SECONDS = float(os.getenv("SIMILAR_INDEX_REFRESH_SECONDS", "30"))
+SIMILAR_JOURNAL_PREFIX = "similar_questions:journal:"
+SIMILAR_JOURNAL_TTL = 30 * 86400
+_JOURNAL_READ_BATCH = 1000
+SIMILAR_MINHASH_PERMUTATIONS = 64
+SIMILAR_LSH_BANDS = 16
+_ROWS_PER_BAND = SIMILAR_MINHASH_PERMUTATIONS // SIMILAR_LSH_BANDS
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+def _permutations():
+    # Fixed seeds so signatures are identical across processes and restarts
+    params = []
+    for i in range(SIMILAR_MINHASH_PERMUTATIONS):
+        digest = hashlib.blake2b(f"minhash-{i}".encode(), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], "big") % (_MERSENNE_PRIME - 1) + 1
+        b = int.from_bytes(digest[8:], "big") % _MERSENNE_PRIME
+        params.append((a, b))
+    return params
+
+
+_PERMUTATIONS = _permutations()
+
+# Terms that must be equal in both questions: quantities, dates and negations
+_NUMBER_WORDS = frozenset("""
+    one two three four five six seven eight nine ten
+    uno dos tres cuatro cinco seis siete ocho nueve diez
+""".split())
+_NEGATION_WORDS = frozenset("""
+    no not never without isn aren don doesn didn won cannot cant
+    sin nunca ni ningun ninguna nao sem pas non nicht kein keine
+""".split())
+
+
+def exact_terms(terms):
+    """The terms of a question that must match exactly for its answer to be reused."""
+    return frozenset(t for t in terms if t.isdigit() or t in _NUMBER_WORDS or t in _NEGATION_WORDS)
+
+
+def question_terms(text):
+    """Content-word set of a question."""
+    terms = set()
+    for word in normalize_question(text).split():
+        if word in FUNCTION_WORDS:
+            continue
+        if len(word) > 3 and word.endswith("s"):
+            word = word[:-1]
+        terms.add(word)
+    return frozenset(terms)
+
+
+def _minhash(terms):
+    hashes = [int.from_bytes(hashlib.blake2b(t.encode("utf-8"), digest_size=8).digest(), "big") for t in terms]
+    return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def _band_keys(signature):
+    return [(band, tuple(signature[band * _ROWS_PER_BAND:(band + 1) * _ROWS_PER_BAND]))
+            for band in range(SIMILAR_LSH_BANDS)]
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class _LanguageIndex:
+    def __init__(self):
+        self.entries = OrderedDict()  # terms -> (answer, band keys)
+        self.buckets = {}
+
+    def remove(self, terms):
+        entry = self.entries.pop(terms, None)
+        if entry is None:
+            return
+        for key in entry[1]:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(terms)
+                if not bucket:
+                    del self.buckets[key]
+
+    def add(self, terms, answer):
+        if terms in self.entries:
+            self.entries.move_to_end(terms)
+            self.entries[terms] = (answer, self.entries[terms][1])
+            return
+        keys = _band_keys(_minhash(terms))
+        self.entries[terms] = (answer, keys)
+        for key in keys:
+            self.buckets.setdefault(key, set()).add(terms)
+        while len(self.entries) > SIMILAR_INDEX_MAX_ENTRIES:
+            self.remove(next(iter(self.entries)))
+
+    def lookup(self, terms):
+        candidates = set()
+        for key in _band_keys(_minhash(terms)):
+            candidates |= self.buckets.get(key, set())
+        required = exact_terms(terms)
+        best, best_score = None, 0.0
+        for candidate in candidates:
+            if exact_terms(candidate) != required:
+                continue
+            score = jaccard(terms, candidate)
+            if score > best_score:
+                best, best_score = candidate, score
+        if best is None:
+            return None, 0.0, None
+        return self.entries[best][0], best_score, best
+
+
+class SimilarQuestionIndex:
+    """Per-language MinHash LSH index of answered questions, journaled to a Redis stream."""
+
+    def __init__(self, redis_client):
+        self._redis = redis_client
+        self._lock = threading.Lock()
+        self._indexes = {}
+        self._kb_version = None
+        self._last_id = "0"
+        self._refreshed_at = 0.0
+
+    def lookup(self, question, language):
+        """Return the stored answer to the most similar question, or None."""
+        terms = question_terms(question)
+        if not terms:
+            return None
+        self._maybe_refresh()
+        with self._lock:
+            index = self._indexes.get(language)
+            answer, score, _ = index.lookup(terms) if index else (None, 0.0, None)
+        if answer is not None and score >= SIMILAR_QUESTION_THRESHOLD:
+            metrics.incr("similar_questions.hits")
+            metrics.observe("similar_questions.similarity", score)
+            return answer
+        metrics.incr("similar_questions.misses")
+        return None
+
+    def discard(self, question, language):
+        """Drop the entry that answers question in this process (its answer was rejected)."""
+        terms = question_terms(question)
+        with self._lock:
+            index = self._indexes.get(language)
+            if not terms or index is None:
+                return
+            _, _, matched = index.lookup(terms)
+            if matched is not None:
+                index.remove(matched)
+        metrics.incr("similar_questions.discarded")
+
+    def add(self, question, language, answer):
+        """Index an answered question and append it to the journal."""
+        terms = question_terms(question)
+        if not terms:
+            return
+        with self._lock:
+            self._add(terms, language, answer)
+        entry = json.dumps({"q": sorted(terms), "lang": language, "a": answer}, ensure_ascii=False)
+        key = SIMILAR_JOURNAL_PREFIX + knowledge_base.current_version()
+        try:
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.xadd(key, {"entry": entry}, maxlen=2 * SIMILAR_INDEX_MAX_ENTRIES, approximate=True)
+            pipe.expire(key, SIMILAR_JOURNAL_TTL)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Failed to journal similar question: {e}")
+
+    def _add(self, terms, language, answer):
+        self._indexes.setdefault(language, _LanguageIndex()).add(terms, answer)
+
+    def _maybe_refresh(self):
+        version = knowledge_base.current_version()
+        if version != self._kb_version:
+            # New knowledge base: drop answers built on the old one and replay its journal
+            with self._lock:
+                self._kb_version = version
+                self._indexes = {}
+                self._last_id = "0"
+            self._refreshed_at = 0.0
+        if time.monotonic() - self._refreshed_at < SIMILAR_INDEX_REFRESH_SECONDS:
+            return
+        self._refreshed_at = time.monotonic()
+        try:
+            self.refresh()
+        except redis.RedisError as e:
+            logger.warning(f"Failed to refresh similar-question index: {e}")
+
+    def refresh(self):
+        """Apply journal entries added since the last refresh (all of them on first use)."""
+        key = SIMILAR_JOURNAL_PREFIX + self._kb_version
+        applied = 0
+        while True:
+            batch = self._redis.xrange(key, min=self._last_id, count=_JOURNAL_READ_BATCH + 1)
+            # The range includes the last applied entry itself
+            batch = [(entry_id, fields) for entry_id, fields in batch if entry_id != self._last_id]
+            if not batch:
+                break
+            with self._lock:
+                for entry_id, fields in batch:
+                    self._last_id = entry_id
+                    try:
+                        entry = json.loads(fields["entry"])
+                    except (KeyError, ValueError):
+                        continue
+                    self._add(frozenset(entry["q"]), entry["lang"], entry["a"])
+                    applied += 1
+        if applied:
+            logger.info(f"✅ Applied {applied} journaled similar questions")
+        for language, index in self._indexes.items():
+            metrics.gauge(f"similar_questions.entries.{language}", len(index.entries))
@@ -47,7 +47,12 @@ document.addEventListener('DOMContentLoaded', function() {
             console.log('New message received:', data);
             
             if (activeConversationId && data.convo_id == activeConversationId) {
-                addMessageToChat(data.message, data.sender, data.username, data.timestamp);
+                const streamed = data.stream_id && findStreamedMessage(data.stream_id);
+                if (streamed) {
+                    // The streamed reply is now persisted; show the final message instead
+                    streamed.remove();
+                }
+                addMessageToChat(data.message, data.sender, data.username, data.timestamp, data.id, data.delivery_status);
                 
                 // Scroll to bottom
                 const messagesContainer = document.querySelector('.messages-container');
@@ -68,6 +73,32 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         });
         
+        socket.on('ai_stream_chunk', function(data) {
+            if (data.convo_id != activeConversationId) {
+                return;
+            }
+            let messageEl = findStreamedMessage(data.stream_id);
+            if (!messageEl) {
+                addMessageToChat('', 'bot', 'AI Bot', new Date().toISOString());
+                messageEl = chatArea.querySelector('.messages-container').lastElementChild;
+                messageEl.dataset.streamId = data.stream_id;
+                messageEl.classList.add('streaming');
+            }
+            const messageContent = messageEl.querySelector('.message-content');
+            messageContent.textContent = data.reset ? data.delta : messageContent.textContent + data.delta;
+            
+            const messagesContainer = document.querySelector('.messages-container');
+            if (messagesContainer) {
+                messagesContainer.scrollTop = messagesContainer.scrollHeight;
+            }
+        });
+        
+        socket.on('delivery_status', function(data) {
+            if (data.convo_id == activeConversationId) {
+                updateDeliveryStatus(data.id, data.delivery_status);
+            }
+        });
+        
         socket.on('error', function(error) {
             console.error('Socket.IO error:', error);
             alert('Communication error: ' + error.message);
@@ -228,7 +259,9 @@ document.addEventListener('DOMContentLoaded', function() {
                         message.message,
                         message.sender,
                         message.sender === 'user' ? data.username : (message.sender === 'bot' ? 'AI Bot' : 'Agent'),
-                        message.timestamp
+                        message.timestamp,
+                        message.id,
+                        message.delivery_status
                     );
                 });
                 
@@ -244,7 +277,7 @@ document.addEventListener('DOMContentLoaded', function() {
     /**
      * Add a message to the chat display
      */
-    function addMessageToChat(content, sender, username, timestamp) {
+    function addMessageToChat(content, sender, username, timestamp, messageId, deliveryStatus) {
         const messagesContainer = chatArea.querySelector('.messages-container');
         const clone = document.importNode(messageTemplate.content, true);
         const messageEl = clone.querySelector('.message');
@@ -260,8 +293,36 @@ document.addEventListener('DOMContentLoaded', function() {
         const messageMeta = clone.querySelector('.message-meta');
         const messageTime = new Date(timestamp).toLocaleTimeString();
         messageMeta.textContent = `${username} • ${messageTime}`;
+        messageMeta.dataset.baseText = messageMeta.textContent;
+        
+        if (messageId) {
+            messageEl.dataset.messageId = messageId;
+        }
         
         messagesContainer.appendChild(clone);
+        
+        if (messageId && deliveryStatus) {
+            updateDeliveryStatus(messageId, deliveryStatus);
+        }
+    }
+    
+    /**
+     * Find the message element of an AI reply that is being streamed
+     */
+    function findStreamedMessage(streamId) {
+        return chatArea.querySelector(`.message[data-stream-id="${CSS.escape(streamId)}"]`);
+    }
+    
+    /**
+     * Show the WhatsApp delivery status (sent, delivered, read, ...) of a message
+     */
+    function updateDeliveryStatus(messageId, deliveryStatus) {
+        const messageEl = chatArea.querySelector(`.message[data-message-id="${messageId}"]`);
+        if (!messageEl) {
+            return;
+        }
+        const messageMeta = messageEl.querySelector('.message-meta');
+        messageMeta.textContent = `${messageMeta.dataset.baseText} • ${deliveryStatus}`;
     }
     
     /**
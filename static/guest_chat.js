@@ -62,10 +62,33 @@ document.addEventListener('DOMContentLoaded', function() {
             console.log('New message received:', data);
             // Ensure the message is for this chat session
             if (data.chat_id === chatId) {
-                addMessageToChat(data.message, data.sender, data.username);
+                const streamed = data.stream_id && findStreamedMessage(data.stream_id);
+                if (streamed) {
+                    // Finalize the streamed reply with the persisted text
+                    streamed.querySelector('.message-content').textContent = data.message;
+                    streamed.classList.remove('message-streaming');
+                } else {
+                    addMessageToChat(data.message, data.sender, data.username);
+                }
             }
         });
 
+        // Partial AI reply while it is being generated
+        socket.on('ai_stream_chunk', (data) => {
+            if (data.chat_id !== chatId) {
+                return;
+            }
+            let messageElement = findStreamedMessage(data.stream_id);
+            if (!messageElement) {
+                messageElement = addMessageToChat('', 'bot', 'AI Bot');
+                messageElement.dataset.streamId = data.stream_id;
+                messageElement.classList.add('message-streaming');
+            }
+            const contentElement = messageElement.querySelector('.message-content');
+            contentElement.textContent = data.reset ? data.delta : contentElement.textContent + data.delta;
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        });
+
         socket.on('error', (error) => {
             console.error('Socket.IO error:', error);
             alert('A connection error occurred. Please refresh the page.');
@@ -90,7 +113,8 @@ document.addEventListener('DOMContentLoaded', function() {
         if (socket) {
             socket.emit('guest_message', {
                 message: message,
-                chat_id: chatId // Send current chat_id, will be null for the first message
+                chat_id: chatId, // Send current chat_id, will be null for the first message
+                client_message_id: generateMessageId() // Lets the server drop resent duplicates
             });
         }
 
@@ -98,11 +122,32 @@ document.addEventListener('DOMContentLoaded', function() {
         messageInput.value = '';
     });
 
+    /**
+     * Generate a unique id for an outgoing message.
+     * @returns {string} A UUID (or a random fallback on older browsers).
+     */
+    function generateMessageId() {
+        if (window.crypto && typeof window.crypto.randomUUID === 'function') {
+            return window.crypto.randomUUID();
+        }
+        return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+    }
+
+    /**
+     * Find the bubble of a reply that is being streamed.
+     * @param {string} streamId - The stream_id of the reply.
+     * @returns {HTMLElement|null} The message element, if any.
+     */
+    function findStreamedMessage(streamId) {
+        return chatMessages.querySelector(`.message[data-stream-id="${CSS.escape(streamId)}"]`);
+    }
+
     /**
      * Add a message to the chat window.
      * @param {string} message - The message content.
      * @param {string} sender - The sender type ('user', 'bot', 'agent').
      * @param {string} username - The display name of the sender.
+     * @returns {HTMLElement} The new message element.
      */
     function addMessageToChat(message, sender, username) {
         const messageElement = document.createElement('div');
@@ -123,5 +168,6 @@ document.addEventListener('DOMContentLoaded', function() {
 
         // Scroll to the bottom of the chat window
         chatMessages.scrollTop = chatMessages.scrollHeight;
+        return messageElement;
     }
 });
@@ -1,21 +1,36 @@
 from __future__ import absolute_import, unicode_literals
 from celery_app import celery_app
-from celery import Celery
+from celery import Celery, signals
 import os
+import threading
 import psycopg2
+import psycopg2.extensions
 from psycopg2.extras import DictCursor
+from psycopg2.pool import ThreadedConnectionPool
 import logging
 import requests
 import json
 from datetime import datetime, timezone
 import time
 import redis
-from twilio.rest import Client
-from langdetect import detect, LangDetectException
+import language_detect
+import knowledge_base
+import prompt_builder
+import token_budget
 from openai import RateLimitError, APIError, AuthenticationError, APITimeoutError
 import socketio
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
-from ai_helpers import get_ai_response
+from ai_helpers import get_ai_response, AI_HISTORY_WINDOW, AI_CALL_MAX_SECONDS, FALLBACK_REPLIES
+import metrics
+import context_cache
+import settings_service
+from message_writer import MessageBatchWriter
+from admission import AdmissionController, canned_reply, holding_reply
+from reply_stream import ReplyStream, stream_id_for
+import response_cache
+from response_cache import ResponseCache
+from similar_questions import SimilarQuestionIndex
+from whatsapp_sender import WhatsAppSender, TwilioSendError, retry_countdown
 
 # Configure logging
 logger = logging.getLogger("chat_server")
@@ -26,51 +41,227 @@ if not logger.handlers:
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
-# Redis client for caching
-redis_client = redis.Redis.from_url(
+# Under the gevent pool (-P gevent, monkey-patched by Celery before this module
+# is imported) make psycopg2 cooperative, so a greenlet waiting on Postgres
+# yields instead of blocking every other in-flight task in the process.
+try:
+    from gevent import monkey as gevent_monkey
+    if gevent_monkey.is_module_patched("socket"):
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+        logger.info("✅ psycopg2 patched for gevent")
+except ImportError:
+    pass
+
+# Redis client for caching. A blocking pool makes greenlets/threads wait for a
+# free connection instead of failing with "Too many connections".
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "10"))
+redis_client = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
     os.getenv('REDIS_URL', 'redis://red-cvfhn5nnoe9s73bhmct0:6379'),
     decode_responses=True,
-    max_connections=10
-)
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=10
+))
 
 # Create a SocketIO client for Celery to emit messages
 # This client only writes to the message queue and doesn't run a server.
 sio = socketio.KombuManager(os.getenv('REDIS_URL', 'redis://red-cvfhn5nnoe9s73bhmct0:6379'), write_only=True)
 
-# Twilio client for WhatsApp
+# Twilio sender for WhatsApp: pooled HTTP session plus a per-number token
+# bucket shared through Redis by every delivery worker
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_WHATSAPP_NUMBER = os.getenv("TWILIO_WHATSAPP_NUMBER")
 
-try:
-    twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-    logger.info("✅ Twilio client initialized")
-except Exception as e:
-    logger.error(f"❌ Failed to initialize Twilio client: {str(e)}")
-    twilio_client = None
+# Public URL of /webhook/whatsapp/status; when unset no delivery statuses are recorded
+WHATSAPP_STATUS_CALLBACK_URL = os.getenv("WHATSAPP_STATUS_CALLBACK_URL")
 
-# Database connection
-def get_db_connection():
+whatsapp_sender = WhatsAppSender(redis_client, TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_WHATSAPP_NUMBER)
+if whatsapp_sender.configured:
+    logger.info("✅ WhatsApp sender initialized")
+else:
+    logger.error("❌ Twilio credentials or WhatsApp number missing; WhatsApp sends are disabled")
+
+# --- DATABASE CONNECTION POOL ---
+# One pool per worker process, created on worker_process_init (or lazily on
+# first use for pools that don't fork). Connections are health-checked only
+# when they have been idle for a while, and returned when each task finishes.
+DB_POOL_MINCONN = int(os.getenv("DB_POOL_MINCONN", "1"))
+DB_POOL_MAXCONN = int(os.getenv("DB_POOL_MAXCONN", "4"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_HEALTHCHECK_IDLE_SECONDS = float(os.getenv("DB_HEALTHCHECK_IDLE_SECONDS", "30"))
+
+db_pool = None
+_db_pool_lock = threading.Lock()
+_db_pool_slots = None
+_db_conn_last_used = {}
+_db_pool_in_use = 0
+
+
+def _get_database_url():
     database_url = os.getenv("DATABASE_URL")
     if not database_url:
         raise ValueError("DATABASE_URL environment variable not set")
-    
+    database_url = database_url.replace("postgres://", "postgresql://", 1)
+
     # Add sslmode=require if not present
     if "sslmode" not in database_url:
-        database_url += "?sslmode=require"
-    
+        database_url += ("&" if "?" in database_url else "?") + "sslmode=require"
+    return database_url
+
+
+def init_db_pool():
+    """Create this process's connection pool if it doesn't exist yet."""
+    global db_pool, _db_pool_slots
+    with _db_pool_lock:
+        if db_pool is not None:
+            return db_pool
+        try:
+            db_pool = ThreadedConnectionPool(
+                DB_POOL_MINCONN,
+                DB_POOL_MAXCONN,
+                _get_database_url(),
+                cursor_factory=DictCursor,
+                connect_timeout=10
+            )
+        except Exception as e:
+            logger.error(f"❌ Database connection pool creation failed: {str(e)}", exc_info=True)
+            raise
+        _db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAXCONN)
+        _db_conn_last_used.clear()
+        metrics.gauge("db_pool.size", DB_POOL_MAXCONN)
+        logger.info(f"✅ Database connection pool initialized (min={DB_POOL_MINCONN}, max={DB_POOL_MAXCONN})")
+        return db_pool
+
+
+def close_db_pool():
+    global db_pool
+    with _db_pool_lock:
+        if db_pool is not None:
+            db_pool.closeall()
+            db_pool = None
+            logger.info("Database connection pool closed")
+
+
+@signals.worker_process_init.connect
+def _init_worker_db_pool(**kwargs):
+    # Connections must never be shared across fork(), so drop anything
+    # inherited from the parent and build a fresh pool for this child.
+    global db_pool
+    db_pool = None
     try:
-        conn = psycopg2.connect(
-            database_url,
-            cursor_factory=DictCursor,
-            connect_timeout=10
-        )
-        logger.info("✅ Database connection established")
-        return conn
+        init_db_pool()
+    except Exception:
+        # get_db_connection() retries lazily on the first task
+        pass
+
+
+@signals.worker_init.connect
+def _preload_language_detector(**kwargs):
+    # Runs before the pool starts, so prefork children inherit loaded profiles
+    language_detect.preload()
+
+
+@signals.worker_init.connect
+def _preload_knowledge_base(**kwargs):
+    # Index qa_reference.txt and build the prompt prefixes once, before the
+    # first request needs them. Runs in the prefork parent, so no update
+    # listener thread is started here; each child starts its own.
+    prompt_builder.preload(knowledge_base.preload())
+    token_budget.preload()
+
+
+@signals.worker_process_shutdown.connect
+def _close_worker_db_pool(**kwargs):
+    close_db_pool()
+    # Prefork children exit without running atexit handlers
+    metrics.retire_process()
+
+
+def _connection_is_healthy(conn):
+    if conn.closed:
+        return False
+    last_used = _db_conn_last_used.get(id(conn))
+    if last_used is not None and time.monotonic() - last_used < DB_HEALTHCHECK_IDLE_SECONDS:
+        return True
+    try:
+        with conn.cursor() as c:
+            c.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def get_db_connection():
+    """Check a connection out of the process pool, waiting up to DB_POOL_TIMEOUT seconds."""
+    global _db_pool_in_use
+    pool = db_pool or init_db_pool()
+
+    wait_start = time.monotonic()
+    if not _db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        metrics.incr("db_pool.timeouts")
+        raise psycopg2.OperationalError(f"Timed out after {DB_POOL_TIMEOUT}s waiting for a pooled database connection")
+    wait_ms = (time.monotonic() - wait_start) * 1000
+    metrics.observe("db_pool.wait_ms", wait_ms)
+
+    try:
+        conn = pool.getconn()
+        if not _connection_is_healthy(conn):
+            logger.warning("Pooled database connection failed health check, reconnecting")
+            metrics.incr("db_pool.reconnects")
+            _db_conn_last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
     except Exception as e:
+        _db_pool_slots.release()
         logger.error(f"❌ Database connection failed: {str(e)}", exc_info=True)
         raise
 
+    with _db_pool_lock:
+        _db_pool_in_use += 1
+        metrics.gauge("db_pool.in_use", _db_pool_in_use)
+    return conn
+
+
+def release_db_connection(conn):
+    """Return a connection to the pool, rolling back any unfinished transaction."""
+    global _db_pool_in_use
+    if conn is None:
+        return
+    pool = db_pool
+    try:
+        if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error as e:
+        logger.warning(f"Rollback before returning connection failed: {str(e)}")
+    try:
+        if pool is not None:
+            _db_conn_last_used[id(conn)] = time.monotonic()
+            pool.putconn(conn, close=bool(conn.closed))
+        else:
+            conn.close()
+    except Exception as e:
+        logger.error(f"❌ Failed to return database connection to pool: {str(e)}")
+    finally:
+        _db_pool_slots.release()
+        with _db_pool_lock:
+            _db_pool_in_use -= 1
+            metrics.gauge("db_pool.in_use", _db_pool_in_use)
+
+
+# Bot replies from concurrent tasks are inserted in group commits
+message_writer = MessageBatchWriter(get_db_connection, release_db_connection)
+
+# Sheds AI work when the ai queue backs up or OpenAI slows down
+admission_controller = AdmissionController(redis_client)
+
+# Replies to first-turn questions, shared by every AI worker
+reply_cache = ResponseCache(redis_client)
+# In-process paraphrase index over the same answers, journaled to Redis
+similar_index = SimilarQuestionIndex(redis_client)
+
+
 # --- DEAD LETTER QUEUE (DLQ) SETUP ---
 DLQ_KEY = os.getenv('DLQ_KEY', 'dead_letter_queue')
 
@@ -87,199 +278,410 @@ def send_to_dead_letter_queue(message, reason, correlation_id=None):
     except Exception as e:
         logger.critical(f"[DLQ][CID:{correlation_id}] Failed to write to DLQ: {str(e)}")
 
+def _send_whatsapp(to_number, message_body, correlation_id, message_id=None):
+    """
+    Send one WhatsApp message via Twilio. Returns False if Twilio isn't configured.
+    message_id (our messages.id) is put on the status callback URL so delivery
+    receipts can be matched to the row.
+    """
+    if not whatsapp_sender.configured:
+        logger.error(f"[CID:{correlation_id}] WhatsApp sender not configured. Cannot send message.")
+        return False
+    start = time.monotonic()
+    status_callback = None
+    if WHATSAPP_STATUS_CALLBACK_URL and message_id:
+        status_callback = f"{WHATSAPP_STATUS_CALLBACK_URL}?message_id={message_id}"
+    sid = whatsapp_sender.send(to_number, message_body, status_callback=status_callback)
+    metrics.observe("whatsapp.send_ms", (time.monotonic() - start) * 1000)
+    logger.info(f"[CID:{correlation_id}] Successfully sent message SID {sid} to {to_number}")
+    return True
+
 @celery_app.task(name="tasks.send_whatsapp_message_task", bind=True, max_retries=3, default_retry_delay=60)
-def send_whatsapp_message_task(self, to_number, message_body, sender_info="system"):
+def send_whatsapp_message_task(self, to_number, message_body, sender_info="system", message_id=None):
     """Sends a WhatsApp message via Twilio."""
     correlation_id = self.request.id or "N/A"
     logger.info(f"[CID:{correlation_id}] Sending WhatsApp message to {to_number}")
-    if not twilio_client:
-        logger.error(f"[CID:{correlation_id}] Twilio client not initialized. Cannot send message.")
+    try:
         # No retry if client is not configured
-        return
+        _send_whatsapp(to_number, message_body, correlation_id, message_id)
+    except TwilioSendError as e:
+        # Rejected by Twilio (bad number, template required, ...): retrying won't help
+        logger.error(f"[CID:{correlation_id}] Twilio rejected WhatsApp message to {to_number}: {e}")
+        send_to_dead_letter_queue({'to_number': to_number, 'message_body': message_body}, reason=str(e), correlation_id=correlation_id)
+    except Exception as e:
+        logger.error(f"[CID:{correlation_id}] Failed to send WhatsApp message to {to_number}: {e}", exc_info=True)
+        metrics.incr("whatsapp.send_retries")
+        # Retry after Twilio's Retry-After on a 429, otherwise back off
+        raise self.retry(exc=e, countdown=retry_countdown(e, self.request.retries))
 
+
+def load_conversation_context(convo_id):
+    """
+    Return the last AI_HISTORY_WINDOW turns as OpenAI chat messages (plus
+    their token counts), oldest first.
+    Served from the Redis context cache; on a miss the window is read from
+    Postgres (via idx_messages_convo_id_timestamp) and the cache repopulated.
+    """
+    conversation_history = context_cache.get_context(convo_id)
+    if conversation_history is not None:
+        metrics.incr("context_cache.hit")
+        return conversation_history
+
+    metrics.incr("context_cache.miss")
+    # Taken before the read, so a turn appended meanwhile stops the repopulate
+    cache_version = context_cache.version(convo_id)
+    conn = None
     try:
-        message = twilio_client.messages.create(
-            from_=f'whatsapp:{TWILIO_WHATSAPP_NUMBER}',
-            body=message_body,
-            to=f'whatsapp:{to_number}'
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute(
+            "SELECT message, sender, timestamp, token_count FROM messages "
+            "WHERE convo_id = %s ORDER BY timestamp DESC, id DESC LIMIT %s",
+            (convo_id, AI_HISTORY_WINDOW)
         )
-        logger.info(f"[CID:{correlation_id}] Successfully sent message SID {message.sid} to {to_number}")
-    except Exception as e:
-        logger.error(f"[CID:{correlation_id}] Failed to send WhatsApp message to {to_number}: {e}", exc_info=True)
-        # Retry on failure
-        raise self.retry(exc=e)
+        history = c.fetchall()
+    finally:
+        release_db_connection(conn)
+    conversation_history = [
+        {
+            "role": context_cache.role_for_sender(msg['sender']), # type: ignore
+            "content": msg['message'], # type: ignore
+            # Rows from before token counts were stored are counted now
+            "tokens": msg['token_count'] if msg['token_count'] is not None else token_budget.count_tokens(msg['message']) # type: ignore
+        }
+        for msg in reversed(history)
+    ]
+    context_cache.populate(convo_id, conversation_history, cache_version)
+    return conversation_history
+
+
+def _load_global_ai_enabled():
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT value, last_updated FROM settings WHERE key = %s", ("ai_enabled",))
+        setting = c.fetchone()
+        if setting:
+            return setting['value'], setting['last_updated'] # type: ignore
+        return "1", None
+    finally:
+        release_db_connection(conn)
+
+
+def _load_conversation_ai_enabled(convo_id):
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT ai_enabled FROM conversations WHERE id = %s", (convo_id,))
+        conversation = c.fetchone()
+        return conversation['ai_enabled'] if conversation else 0 # type: ignore
+    finally:
+        release_db_connection(conn)
+
+
+def is_ai_enabled(convo_id):
+    """Global and per-conversation AI flags, both served from the shared settings cache."""
+    global_ai_enabled, _ = settings_service.get(settings_service.GLOBAL_AI_ENABLED, _load_global_ai_enabled)
+    if global_ai_enabled != "1":
+        return False
+    conversation_ai_enabled = settings_service.get(
+        settings_service.conversation_ai_key(convo_id),
+        lambda: _load_conversation_ai_enabled(convo_id)
+    )
+    return conversation_ai_enabled == 1
+
+
+def _retry_with_dlq(task, exc, payload, correlation_id):
+    """Record a failed stage in the DLQ and schedule a Celery retry, categorised by error type."""
+    if isinstance(exc, psycopg2.OperationalError):
+        reason, countdown = f"DB operational error: {str(exc)}", 60
+    elif isinstance(exc, redis.ConnectionError):
+        reason, countdown = f"Redis error: {str(exc)}", 60
+    else:
+        reason, countdown = f"General error: {str(exc)}", 120
+    logger.error(f"[CID:{correlation_id}] ❌ {task.name} failed: {reason}", exc_info=True)
+    try:
+        send_to_dead_letter_queue(payload, reason=reason, correlation_id=correlation_id)
+    except Exception:
+        pass
+    # Sentry/monitoring hook
+    try:
+        # sentry_sdk.capture_exception(exc)
+        pass
+    except Exception:
+        pass
+    return task.retry(exc=exc, countdown=countdown, max_retries=3)
+
+
+# Upserts the conversation (bumping last_updated) and inserts the user message
+# in one round trip. xmax = 0 only for freshly inserted rows, which tells the
+# caller whether the conversation is new. A new conversation takes the
+# detected language; an existing one only switches on strong evidence, so
+# guests changing language mid-thread are followed without an extra
+# statement. A message whose external_id was
+# already stored inserts nothing, so the statement returns no row.
+INGEST_MESSAGE_SQL = """
+    WITH convo AS (
+        INSERT INTO conversations (username, chat_id, channel, ai_enabled, language, last_updated)
+        VALUES (%(username)s, %(chat_id)s, %(channel)s, 1, COALESCE(%(language)s, %(default_language)s), %(timestamp)s)
+        ON CONFLICT (chat_id) DO UPDATE
+        SET last_updated = GREATEST(conversations.last_updated, EXCLUDED.last_updated),
+            language = COALESCE(%(switch_language)s, conversations.language)
+        RETURNING id, username, ai_enabled, language, (xmax = 0) AS created
+    ), msg AS (
+        INSERT INTO messages (convo_id, username, message, sender, timestamp, external_id, token_count)
+        SELECT id, username, %(message)s, 'user', %(timestamp)s, %(external_id)s, %(token_count)s FROM convo
+        ON CONFLICT (external_id) DO NOTHING
+        RETURNING id
+    )
+    SELECT convo.id AS convo_id, convo.username, convo.ai_enabled, convo.language,
+           convo.created, msg.id AS message_id
+    FROM convo, msg
+"""
+
+
+# --- INBOUND PIPELINE ---
+# process_incoming_message (ingest queue): persist + notify the dashboard
+#   -> generate_ai_reply (ai queue): OpenAI call + persist the reply
+#   -> deliver_ai_reply (delivery queue): Socket.IO emit + WhatsApp send
+# Each stage is its own task so a slow OpenAI call never delays the inbound
+# notification and the AI stage can be scaled independently.
+
+# How long ingested message keys are remembered in Redis. Postgres'
+# idx_messages_external_id still catches duplicates after this expires.
+# The key holds the stored message's ids and is only marked done once the
+# message has been handed to the AI stage (or answered without AI), so a
+# retry after the commit resumes from there instead of dropping the message.
+INGEST_DEDUP_TTL = int(os.getenv("INGEST_DEDUP_TTL", "86400"))
+
+# Seconds to wait for follow-up messages before generating one AI reply for
+# the whole burst (0 disables coalescing).
+AI_DEBOUNCE_SECONDS = float(os.getenv("AI_DEBOUNCE_SECONDS", "2"))
+AI_PENDING_TTL = 3600
+
+
+# At most one AI generation runs per conversation. The lease outlives the
+# slowest OpenAI call (every attempt timing out, plus the waits between
+# them) with a margin for the rest of the task; contenders re-queue
+# themselves.
+AI_LEASE_SECONDS = int(os.getenv("AI_LEASE_SECONDS", str(int(AI_CALL_MAX_SECONDS) + 60)))
+if AI_LEASE_SECONDS < AI_CALL_MAX_SECONDS:
+    logger.warning(f"⚠️ AI_LEASE_SECONDS={AI_LEASE_SECONDS} is shorter than the slowest AI call ({AI_CALL_MAX_SECONDS:.0f}s); generations may overlap")
+AI_LEASE_RETRY_SECONDS = float(os.getenv("AI_LEASE_RETRY_SECONDS", "1"))
+
+# Delete the lease only if we still own it
+_release_lease_script = redis_client.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+
+# Minimum seconds between holding messages to one conversation while shedding
+HOLDING_REPLY_INTERVAL = int(os.getenv("HOLDING_REPLY_INTERVAL", "300"))
+
+# Per-message stage checkpoints, so retries resume where they failed
+CHECKPOINT_TTL = int(os.getenv("CHECKPOINT_TTL", "86400"))
+
+
+def _checkpoint_key(stage, message_id):
+    return f"checkpoint:{stage}:{message_id}"
+
+
+def load_checkpoint(key):
+    return redis_client.hgetall(key)
+
+
+def save_checkpoint(key, **fields):
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hset(key, mapping=fields)
+    pipe.expire(key, CHECKPOINT_TTL)
+    pipe.execute()
+
+
+def _ingested_key(external_id):
+    return f"ingest:seen:{external_id}"
+
+
+def load_ingest_record(external_id):
+    """The ingest record of an already stored message, or None if it wasn't seen."""
+    raw = redis_client.get(_ingested_key(external_id))
+    if raw is None:
+        return None
+    if raw == "1":
+        # Written before records were kept: the message was fully handled
+        return {"done": True}
+    return json.loads(raw)
+
+
+def save_ingest_record(external_id, record, done=False):
+    redis_client.set(_ingested_key(external_id), json.dumps(dict(record, done=done)), ex=INGEST_DEDUP_TTL)
+
+
+# A message stored by an earlier attempt. It counts as handled once anything
+# newer was logged in its conversation (a reply, or a later guest message
+# whose reply covers it).
+LOAD_INGESTED_MESSAGE_SQL = """
+    SELECT m.id AS message_id, m.convo_id, c.username, c.language,
+           EXISTS (SELECT 1 FROM messages later WHERE later.convo_id = m.convo_id AND later.id > m.id) AS handled
+    FROM messages m JOIN conversations c ON c.id = m.convo_id
+    WHERE m.external_id = %s
+"""
+
+
+def _pending_ai_key(convo_id):
+    return f"ai:pending:{convo_id}"
+
+
+def _ai_lease_key(convo_id):
+    return f"ai:lease:{convo_id}"
+
+
+def acquire_ai_lease(convo_id, token):
+    return bool(redis_client.set(_ai_lease_key(convo_id), token, nx=True, ex=AI_LEASE_SECONDS))
+
+
+def release_ai_lease(convo_id, token):
+    try:
+        _release_lease_script(keys=[_ai_lease_key(convo_id)], args=[token])
+    except redis.RedisError as e:
+        # The lease expires on its own after AI_LEASE_SECONDS
+        logger.error(f"Failed to release AI lease for convo_id {convo_id}: {e}")
+
+
+def _dispatch_reply(convo_id, message_id, username, chat_id, channel, message_body, language, correlation_id, user_timestamp):
+    """Queue AI generation for a stored message, or answer it without AI while shedding."""
+    ai_enabled = is_ai_enabled(convo_id)
+    shed_reason = admission_controller.overload_reason() if ai_enabled else None
+    if shed_reason:
+        logger.warning(f"[CID:{correlation_id}] AI overloaded ({shed_reason}); answering message {message_id} without AI")
+        _reply_without_ai(convo_id, message_id, chat_id, channel, message_body, language, shed_reason, correlation_id)
+    elif ai_enabled:
+        logger.info(f"[CID:{correlation_id}] AI is enabled for conversation {convo_id}. Queueing AI generation...")
+        # Mark this as the newest message awaiting a reply; generation is
+        # delayed by the debounce window so a burst ends up as one call.
+        redis_client.set(_pending_ai_key(convo_id), message_id, ex=AI_PENDING_TTL)
+        generate_ai_reply.apply_async(kwargs={
+            'convo_id': convo_id,
+            'message_id': message_id,
+            'username': username,
+            'chat_id': chat_id,
+            'channel': channel,
+            'message_body': message_body,
+            'language': language,
+            'correlation_id': correlation_id,
+            'user_timestamp': user_timestamp
+        }, countdown=AI_DEBOUNCE_SECONDS or None)
+
+
+def _resume_ingest(external_id, record, chat_id, channel, message_body, correlation_id, user_timestamp):
+    """Finish a message an earlier attempt stored but didn't hand to the AI stage."""
+    metrics.incr("ingest.resumed")
+    logger.info(f"[CID:{correlation_id}] Message {external_id} already stored as {record['message_id']}; resuming")
+    _dispatch_reply(record['convo_id'], record['message_id'], record['username'], chat_id, channel,
+                    message_body, record['language'], correlation_id, user_timestamp)
+    save_ingest_record(external_id, record, done=True)
+    return {"status": "resumed", "convo_id": record['convo_id']}
 
 
 @celery_app.task(name="tasks.process_incoming_message", bind=True, max_retries=3)
-def process_incoming_message(self, from_number, chat_id, message_body, user_timestamp, channel, sid=None):
+def process_incoming_message(self, from_number, chat_id, message_body, user_timestamp, channel, sid=None, message_key=None):
     """
-    Process an incoming message from any channel (WhatsApp, Web).
-    Enhanced: error categorization, retry, DLQ, correlation ID, Sentry hook.
+    Persist an incoming message from any channel (WhatsApp, Web), notify the
+    dashboard and queue AI generation if AI is enabled for the conversation.
+    message_key is the provider/client message id (Twilio MessageSid, web
+    client id); redelivered or retried copies of the same key are dropped.
     """
     import uuid
     correlation_id = str(uuid.uuid4())
     start_time = time.time()
     logger.info(f"[CID:{correlation_id}] Processing {channel} message from {chat_id}: '{message_body[:50]}...'")
+    external_id = f"{channel}:{message_key}" if message_key else None
+    conn = None
     try:
-        conn = None
+        # Fast path: already ingested, skip the DB and the model entirely
+        record = load_ingest_record(external_id) if external_id else None
+        if record is not None:
+            if record.get("done"):
+                metrics.incr("ingest.duplicates")
+                logger.info(f"[CID:{correlation_id}] Duplicate message {external_id} dropped")
+                return {"status": "duplicate"}
+            return _resume_ingest(external_id, record, chat_id, channel, message_body, correlation_id, user_timestamp)
+
         try:
             conn = get_db_connection()
             c = conn.cursor()
         except Exception as db_init_err:
             logger.error(f"[CID:{correlation_id}] DB connection failed: {str(db_init_err)}", exc_info=True)
             raise
-        # Check if conversation exists for this chat_id
-        c.execute(
-            "SELECT id, username, ai_enabled, language FROM conversations WHERE chat_id = %s AND channel = %s",
-            (chat_id, channel)
-        )
-        conversation = c.fetchone()
-        
-        if conversation:
-            convo_id = conversation['id'] # type: ignore
-            username = conversation['username'] # type: ignore
-            ai_enabled = conversation['ai_enabled'] # type: ignore
-            language = conversation['language'] # type: ignore
-            logger.info(f"Found existing conversation for {chat_id}: ID {convo_id}, user '{username}'")
-        else:
-            # Create a new conversation
-            username = f"{channel.capitalize()}_{chat_id}"
-            
-            # Try to detect language (default to English if detection fails)
-            try:
-                language = detect(message_body)
-                logger.info(f"Detected language for new conversation: {language}")
-            except LangDetectException:
-                language = 'en'
-                logger.warning(f"Could not detect language for message '{message_body[:30]}...'. Using default: {language}")
-            
-            # Insert new conversation
-            c.execute(
-                "INSERT INTO conversations (username, chat_id, channel, ai_enabled, language, last_updated) "
-                "VALUES (%s, %s, %s, %s, %s, %s) RETURNING id",
-                (username, chat_id, channel, 1, language, user_timestamp)
-            )
-            convo_id = c.fetchone()['id'] # type: ignore
-            ai_enabled = 1
-            logger.info(f"Created new conversation for {chat_id}: ID {convo_id}, language: {language}")
+        # None when the message is inconclusive (e.g. "ok"). An existing
+        # conversation only follows switch_language, which takes more than a
+        # single stopword like "no" or "gracias".
+        detected_language, switch_language = language_detect.detect_for_conversation(chat_id, message_body)
+        # Stored with the message so history packing never re-tokenizes it
+        token_count = token_budget.count_tokens(message_body)
 
-            # For new web chats, notify the client of its new convo_id and chat_id
-            if channel == 'web' and sid:
-                try:
-                    sio.emit('session_assigned', {
-                        'convo_id': convo_id,
-                        'chat_id': chat_id
-                    }, to=sid)
-                    logger.info(f"[CID:{correlation_id}] Emitted 'session_assigned' to sid {sid} with convo_id {convo_id}")
-                except Exception as e:
-                    logger.error(f"[CID:{correlation_id}] Failed to emit 'session_assigned' to sid {sid}: {e}")
-
-        # Log the user message
-        c.execute(
-            "INSERT INTO messages (convo_id, username, message, sender, timestamp) "
-            "VALUES (%s, %s, %s, %s, %s) RETURNING id",
-            (convo_id, username, message_body, "user", user_timestamp)
-        )
-        message_id = c.fetchone()['id'] # type: ignore
-        logger.info(f"Logged user message with ID {message_id} for convo_id {convo_id}")
-        
-        # Update conversation timestamp
-        c.execute(
-            "UPDATE conversations SET last_updated = %s WHERE id = %s",
-            (user_timestamp, convo_id)
-        )
+        # Resolve-or-create the conversation, log the user message, bump
+        # last_updated and follow language switches in a single statement
+        settings_generation = settings_service.generation()
+        c.execute(INGEST_MESSAGE_SQL, {
+            'username': f"{channel.capitalize()}_{chat_id}",
+            'chat_id': chat_id,
+            'channel': channel,
+            'message': message_body,
+            'timestamp': user_timestamp,
+            'external_id': external_id,
+            'language': detected_language,
+            'switch_language': switch_language,
+            'default_language': language_detect.DEFAULT_LANGUAGE,
+            'token_count': token_count
+        })
+        ingested = c.fetchone()
+        if ingested is None:
+            # The message insert hit the external_id unique index
+            conn.rollback()
+            c.execute(LOAD_INGESTED_MESSAGE_SQL, (external_id,))
+            stored = c.fetchone()
+            if stored is not None and not stored['handled']: # type: ignore
+                # Stored by an attempt that failed before queueing the reply
+                record = {key: stored[key] for key in ('convo_id', 'message_id', 'username', 'language')} # type: ignore
+                return _resume_ingest(external_id, record, chat_id, channel, message_body, correlation_id, user_timestamp)
+            save_ingest_record(external_id, {}, done=True)
+            metrics.incr("ingest.duplicates")
+            logger.info(f"[CID:{correlation_id}] Duplicate message {external_id} dropped")
+            return {"status": "duplicate"}
+        convo_id = ingested['convo_id'] # type: ignore
+        username = ingested['username'] # type: ignore
+        ai_enabled = ingested['ai_enabled'] # type: ignore
+        language = ingested['language'] # type: ignore
+        message_id = ingested['message_id'] # type: ignore
+
+        language_detect.remember(chat_id, language)
+
+        if ingested['created']: # type: ignore
+            logger.info(f"Created new conversation for {chat_id}: ID {convo_id}, language: {language}")
+        else:
+            logger.info(f"Found existing conversation for {chat_id}: ID {convo_id}, user '{username}'")
         conn.commit()
-        
-        # Get conversation history for AI context
-        c.execute(
-            "SELECT message, sender, timestamp FROM messages "
-            "WHERE convo_id = %s ORDER BY timestamp ASC",
-            (convo_id,)
-        )
-        history = c.fetchall()
-        
-        # Format conversation history for OpenAI
-        conversation_history = []
-        for msg in history:
-            role = "user" if msg['sender'] == "user" else "assistant" # type: ignore
-            conversation_history.append({"role": role, "content": msg['message']}) # type: ignore
-        
-        # Check if AI is globally enabled
-        c.execute("SELECT value FROM settings WHERE key = %s", ("ai_enabled",))
-        setting = c.fetchone()
-        global_ai_enabled = setting['value'] if setting else "1" # type: ignore
-        
-        # Process with AI if enabled
-        if global_ai_enabled == "1" and ai_enabled == 1:
-            logger.info(f"[CID:{correlation_id}] AI is enabled for conversation {convo_id}. Generating response...")
+        record = {'convo_id': convo_id, 'message_id': message_id, 'username': username, 'language': language}
+        if external_id:
+            save_ingest_record(external_id, record)
+        logger.info(f"Logged user message with ID {message_id} for convo_id {convo_id}")
+
+        # For new web chats, notify the client of its new convo_id and chat_id
+        if ingested['created'] and channel == 'web' and sid: # type: ignore
             try:
-                # The new get_ai_response function has a simpler signature
-                ai_reply = get_ai_response(
-                    prompt=message_body,
-                    conversation_history=conversation_history
-                )
-            except Exception as ai_err:
-                logger.error(f"[CID:{correlation_id}] AI response failed: {str(ai_err)}", exc_info=True)
-                send_to_dead_letter_queue({
-                    'from_number': from_number,
-                    'chat_id': chat_id,
-                    'message_body': message_body,
-                    'user_timestamp': user_timestamp
-                }, reason=f"AI error: {str(ai_err)}", correlation_id=correlation_id)
-                # Sentry/monitoring hook
-                try:
-                    # sentry_sdk.capture_exception(ai_err)
-                    pass
-                except Exception:
-                    pass
-                raise
-            # Log AI response
-            if ai_reply:
-                c.execute(
-                    "INSERT INTO messages (convo_id, username, message, sender, timestamp) "
-                    "VALUES (%s, %s, %s, %s, %s) RETURNING id",
-                    (convo_id, "AI Bot", ai_reply, "bot", datetime.now(timezone.utc).isoformat())
-                )
-                ai_message_id = c.fetchone()['id'] # type: ignore
-                logger.info(f"Logged AI response with ID {ai_message_id} for convo_id {convo_id}")
-                
-                # Send AI response via the appropriate channel
-                if channel == 'whatsapp':
-                    send_whatsapp_message_task.delay(
-                        to_number=chat_id,
-                        message_body=ai_reply
-                    )
-                elif channel == 'web':
-                    # For web, we emit a socketio event back to the client
-                    try:
-                        room = f"convo_{convo_id}"
-                        sio.emit('new_message', {
-                            'id': ai_message_id,
-                            'convo_id': convo_id,
-                            'username': 'AI Bot',
-                            'message': ai_reply,
-                            'sender': 'bot',
-                            'timestamp': datetime.now(timezone.utc).isoformat(),
-                            'chat_id': chat_id,
-                            'channel': channel
-                        }, room=room) # Corrected: use room= instead of to=
-                        logger.info(f"Emitted AI response via Socket.IO to room {room}")
-                    except Exception as e:
-                        logger.error(f"Failed to emit Socket.IO event for AI reply: {str(e)}")
-
-
-                # Handoff logic is removed as it's not part of the simplified get_ai_response
-                # if handoff_triggered:
-                #     c.execute(
-                #         "UPDATE conversations SET needs_agent = 1, booking_intent = %s WHERE id = %s",
-                #         (detected_intent, convo_id)
-                #     )
-                #     logger.info(f"Updated conversation {convo_id} with handoff flag and intent: {detected_intent}")
-            else:
-                logger.error(f"No AI response generated for convo_id {convo_id}")
-                
-        conn.commit()
-        
+                sio.emit('session_assigned', {
+                    'convo_id': convo_id,
+                    'chat_id': chat_id
+                }, to=sid)
+                logger.info(f"[CID:{correlation_id}] Emitted 'session_assigned' to sid {sid} with convo_id {convo_id}")
+            except Exception as e:
+                logger.error(f"[CID:{correlation_id}] Failed to emit 'session_assigned' to sid {sid}: {e}")
+
         # Emit to Socket.IO that a new message arrived (for dashboard)
         try:
             # Emit to Socket.IO using the write-only KombuManager
@@ -297,49 +699,284 @@ def process_incoming_message(self, from_number, chat_id, message_body, user_time
             logger.info(f"Emitted Socket.IO 'new_message' event to room {room}")
         except Exception as e:
             logger.error(f"Failed to emit Socket.IO event: {str(e)}")
-        
+
+        # Keep the cached rolling context in step with the DB
+        context_cache.append_message(convo_id, "user", message_body, token_count)
+
+        # The ingest statement already returned the conversation's flag
+        # (ignored if an agent toggled it while the statement ran)
+        settings_service.prime(settings_service.conversation_ai_key(convo_id), ai_enabled, settings_generation)
+
+        _dispatch_reply(convo_id, message_id, username, chat_id, channel, message_body, language, correlation_id, user_timestamp)
+        if external_id:
+            save_ingest_record(external_id, record, done=True)
+
         processing_time = time.time() - start_time
-        logger.info(f"[CID:{correlation_id}] {channel.capitalize()} message processed in {processing_time:.2f} seconds")
+        logger.info(f"[CID:{correlation_id}] {channel.capitalize()} message persisted in {processing_time:.2f} seconds")
         return {"status": "success", "convo_id": convo_id, "processing_time": processing_time}
-    except psycopg2.OperationalError as db_op_err:
-        logger.error(f"[CID:{correlation_id}] Database operational error: {str(db_op_err)}", exc_info=True)
-        try:
-            send_to_dead_letter_queue({
-                'from_number': from_number,
-                'chat_id': chat_id,
-                'message_body': message_body,
-                'user_timestamp': user_timestamp
-            }, reason=f"DB operational error: {str(db_op_err)}", correlation_id=correlation_id)
-        except Exception:
-            pass
-        raise self.retry(exc=db_op_err, countdown=60, max_retries=3)
-    except redis.ConnectionError as redis_err:
-        logger.error(f"[CID:{correlation_id}] Redis connection error: {str(redis_err)}", exc_info=True)
-        try:
-            send_to_dead_letter_queue({
-                'from_number': from_number,
-                'chat_id': chat_id,
-                'message_body': message_body,
-                'user_timestamp': user_timestamp
-            }, reason=f"Redis error: {str(redis_err)}", correlation_id=correlation_id)
-        except Exception:
-            pass
-        raise self.retry(exc=redis_err, countdown=60, max_retries=3)
     except Exception as e:
-        logger.error(f"[CID:{correlation_id}] ❌ Error processing {channel} message: {str(e)}", exc_info=True)
+        raise _retry_with_dlq(self, e, {
+            'from_number': from_number,
+            'chat_id': chat_id,
+            'message_body': message_body,
+            'user_timestamp': user_timestamp
+        }, correlation_id)
+    finally:
+        release_db_connection(conn)
+
+
+@celery_app.task(name="tasks.generate_ai_reply", bind=True, max_retries=3)
+def generate_ai_reply(self, convo_id, message_id, username, chat_id, channel, message_body, language=None, correlation_id=None, user_timestamp=None):
+    """
+    Generate and persist the AI reply to a stored user message, then queue its
+    delivery. Progress is checkpointed per message, so a retry reuses an
+    already generated reply instead of calling OpenAI again.
+    """
+    correlation_id = correlation_id or self.request.id or "N/A"
+    start_time = time.time()
+    payload = {
+        'convo_id': convo_id,
+        'message_id': message_id,
+        'chat_id': chat_id,
+        'message_body': message_body
+    }
+    checkpoint_key = _checkpoint_key("generate", message_id)
+    lease_token = None
+    try:
+        checkpoint = load_checkpoint(checkpoint_key)
+        if "ai_message_id" in checkpoint:
+            # Reply already stored; only the hand-off to delivery may be missing
+            metrics.incr("ai.checkpoint_resumed")
+            logger.info(f"[CID:{correlation_id}] Reply to message {message_id} already persisted; re-queueing delivery")
+            _queue_delivery(convo_id, int(checkpoint["ai_message_id"]), chat_id, channel,
+                            checkpoint["ai_reply"], checkpoint["timestamp"], correlation_id,
+                            stream_id_for(message_id) if channel == 'web' else None)
+            return {"status": "resumed", "convo_id": convo_id, "ai_message_id": int(checkpoint["ai_message_id"])}
+
+        ai_reply = checkpoint.get("ai_reply")
+        timestamp = checkpoint.get("timestamp")
+        if ai_reply is None:
+            # A newer message arrived during the debounce window; its task will
+            # answer the whole burst, since the context holds every user turn.
+            latest_pending = redis_client.get(_pending_ai_key(convo_id))
+            if latest_pending is not None and int(latest_pending) != message_id:
+                metrics.incr("ai.coalesced")
+                logger.info(f"[CID:{correlation_id}] Message {message_id} superseded by {latest_pending} in convo_id {convo_id}; skipping AI call")
+                return {"status": "coalesced", "convo_id": convo_id}
+
+        # An agent may have switched AI off while this message was queued
+        if ai_reply is None and not is_ai_enabled(convo_id):
+            logger.info(f"[CID:{correlation_id}] AI disabled for convo_id {convo_id}; skipping AI call")
+            return {"status": "ai_disabled", "convo_id": convo_id}
+
+        # Answering minutes late is worse than handing over to an agent now
+        if ai_reply is None and admission_controller.is_stale(user_timestamp):
+            logger.warning(f"[CID:{correlation_id}] Message {message_id} is stale; answering without AI")
+            _reply_without_ai(convo_id, message_id, chat_id, channel, message_body, language, "stale", correlation_id)
+            return {"status": "shed", "convo_id": convo_id}
+
+        # Serialize generations within a conversation so each one sees the
+        # previous reply and replies can't race each other
+        token = self.request.id or correlation_id
+        if not acquire_ai_lease(convo_id, token):
+            metrics.incr("ai.lease_contended")
+            logger.info(f"[CID:{correlation_id}] AI generation already running for convo_id {convo_id}; deferring message {message_id}")
+            generate_ai_reply.apply_async(kwargs=self.request.kwargs, countdown=AI_LEASE_RETRY_SECONDS)
+            return {"status": "deferred", "convo_id": convo_id}
+        lease_token = token
+
+        stream_id = stream_id_for(message_id) if channel == 'web' else None
+        if ai_reply is None:
+            conversation_history = load_conversation_context(convo_id)
+            reply_language = language or "en"
+            # First-turn questions repeat across guests; answer them from the cache
+            cacheable = response_cache.is_cacheable(conversation_history, message_body)
+            if cacheable:
+                ai_reply = reply_cache.get(message_body, reply_language)
+                if ai_reply is not None:
+                    logger.info(f"[CID:{correlation_id}] Answered message {message_id} from the response cache")
+                else:
+                    # Paraphrases of an answered question reuse its answer
+                    ai_reply = similar_index.lookup(message_body, reply_language)
+                    if ai_reply is not None and reply_cache.is_rejected(ai_reply):
+                        # An agent rejected this answer; the journal may still replay it
+                        similar_index.discard(message_body, reply_language)
+                        ai_reply = None
+                    if ai_reply is not None:
+                        logger.info(f"[CID:{correlation_id}] Answered message {message_id} from a similar question")
+                        reply_cache.put(message_body, reply_language, ai_reply)
+            if ai_reply is None:
+                ai_reply = _call_ai(convo_id, username, chat_id, channel, message_body, reply_language,
+                                    conversation_history, stream_id, correlation_id)
+                if cacheable and ai_reply and ai_reply not in FALLBACK_REPLIES and not reply_cache.is_rejected(ai_reply):
+                    reply_cache.put(message_body, reply_language, ai_reply)
+                    similar_index.add(message_body, reply_language, ai_reply)
+
+            if not ai_reply:
+                logger.error(f"No AI response generated for convo_id {convo_id}")
+                return {"status": "empty", "convo_id": convo_id}
+            timestamp = datetime.now(timezone.utc).isoformat()
+            save_checkpoint(checkpoint_key, ai_reply=ai_reply, timestamp=timestamp)
+        else:
+            metrics.incr("ai.checkpoint_resumed")
+            logger.info(f"[CID:{correlation_id}] Reusing checkpointed AI reply for message {message_id}")
+
+        # Group-committed with replies from other in-flight tasks. The reply
+        # is keyed on the message it answers, so a retry after a lost commit
+        # acknowledgement gets the existing row back.
+        reply_tokens = token_budget.count_tokens(ai_reply)
+        ai_message_id = message_writer.write(
+            convo_id, "AI Bot", ai_reply, "bot", timestamp, f"reply:{message_id}", reply_tokens
+        )
+        save_checkpoint(checkpoint_key, ai_message_id=ai_message_id)
+        context_cache.append_message(convo_id, "bot", ai_reply, reply_tokens)
+        logger.info(f"Logged AI response with ID {ai_message_id} for convo_id {convo_id}")
+
+        _queue_delivery(convo_id, ai_message_id, chat_id, channel, ai_reply, timestamp, correlation_id, stream_id)
+        processing_time = time.time() - start_time
+        logger.info(f"[CID:{correlation_id}] AI reply for convo_id {convo_id} generated in {processing_time:.2f} seconds")
+        return {"status": "success", "convo_id": convo_id, "ai_message_id": ai_message_id, "processing_time": processing_time}
+    except Exception as e:
+        raise _retry_with_dlq(self, e, payload, correlation_id)
+    finally:
+        if lease_token:
+            release_ai_lease(convo_id, lease_token)
+
+
+def _call_ai(convo_id, username, chat_id, channel, message_body, language, conversation_history, stream_id, correlation_id):
+    """Get a reply from OpenAI, streaming it to the web guest when stream_id is set."""
+    # Web guests see the reply as it is generated
+    reply_stream = None
+    if stream_id:
+        reply_stream = ReplyStream(sio, _reply_rooms(convo_id, chat_id, channel), convo_id, chat_id, stream_id)
+    ai_start = time.time()
+    try:
+        ai_reply, detected_intent, handoff_triggered = get_ai_response(
+            convo_id=convo_id,
+            username=username,
+            conversation_history=conversation_history,
+            user_message=message_body,
+            chat_id=chat_id,
+            channel=channel,
+            language=language,
+            correlation_id=correlation_id,
+            on_text=reply_stream
+        )
+        if reply_stream:
+            reply_stream.close()
+    except Exception as ai_err:
+        logger.error(f"[CID:{correlation_id}] AI response failed: {str(ai_err)}", exc_info=True)
+        raise
+    finally:
+        ai_latency_ms = (time.time() - ai_start) * 1000
+        admission_controller.record_ai_latency(ai_latency_ms)
+        metrics.observe("ai.latency_ms", ai_latency_ms)
+
+    # Handoff logic is removed as it's not part of the simplified get_ai_response
+    # if handoff_triggered:
+    #     c.execute(
+    #         "UPDATE conversations SET needs_agent = 1, booking_intent = %s WHERE id = %s",
+    #         (detected_intent, convo_id)
+    #     )
+    #     logger.info(f"Updated conversation {convo_id} with handoff flag and intent: {detected_intent}")
+    return ai_reply
+
+
+def _reply_without_ai(convo_id, message_id, chat_id, channel, message_body, language, reason, correlation_id):
+    """
+    Answer a shed message immediately: a canned FAQ answer if it asks a
+    common question, otherwise a holding message (at most once per
+    HOLDING_REPLY_INTERVAL) with the conversation flagged for an agent.
+    """
+    reply = canned_reply(message_body, language)
+    if reply:
+        metrics.incr(f"admission.shed.{reason}.canned")
+    else:
+        metrics.incr(f"admission.shed.{reason}.holding")
+        _flag_for_agent(convo_id)
+        if not redis_client.set(f"ai:holding_sent:{convo_id}", 1, nx=True, ex=HOLDING_REPLY_INTERVAL):
+            return
+        reply = holding_reply(language)
+
+    timestamp = datetime.now(timezone.utc).isoformat()
+    reply_tokens = token_budget.count_tokens(reply)
+    ai_message_id = message_writer.write(convo_id, "AI Bot", reply, "bot", timestamp, f"reply:{message_id}", reply_tokens)
+    context_cache.append_message(convo_id, "bot", reply, reply_tokens)
+    _queue_delivery(convo_id, ai_message_id, chat_id, channel, reply, timestamp, correlation_id)
+
+
+def _flag_for_agent(convo_id):
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("UPDATE conversations SET needs_agent = 1 WHERE id = %s", (convo_id,))
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+
+
+def _queue_delivery(convo_id, ai_message_id, chat_id, channel, ai_reply, timestamp, correlation_id, stream_id=None):
+    deliver_ai_reply.delay(
+        convo_id=convo_id,
+        ai_message_id=ai_message_id,
+        chat_id=chat_id,
+        channel=channel,
+        ai_reply=ai_reply,
+        timestamp=timestamp,
+        correlation_id=correlation_id,
+        stream_id=stream_id
+    )
+
+
+def _reply_rooms(convo_id, chat_id, channel):
+    """Socket.IO rooms a reply goes to: the dashboard's convo room, plus the web guest's own room."""
+    rooms = [f"convo_{convo_id}"]
+    if channel == 'web':
+        rooms.append(f"chat_{chat_id}")
+    return rooms
+
+
+@celery_app.task(name="tasks.deliver_ai_reply", bind=True, max_retries=3, default_retry_delay=60)
+def deliver_ai_reply(self, convo_id, ai_message_id, chat_id, channel, ai_reply, timestamp, correlation_id=None, stream_id=None):
+    """
+    Push a persisted AI reply to the conversation room and, for WhatsApp, to
+    the guest. Each step is checkpointed so a retry doesn't repeat it.
+    stream_id links the message to the ai_stream_chunk events it finalizes.
+    """
+    correlation_id = correlation_id or self.request.id or "N/A"
+    checkpoint_key = _checkpoint_key("deliver", ai_message_id)
+    checkpoint = load_checkpoint(checkpoint_key)
+
+    # The dashboard's convo room, plus the guest's own room for web chats
+    if "emitted" not in checkpoint:
         try:
-            send_to_dead_letter_queue({
-                'from_number': from_number,
-                'chat_id': chat_id,
-                'message_body': message_body,
-                'user_timestamp': user_timestamp
-            }, reason=f"General error: {str(e)}", correlation_id=correlation_id)
-        except Exception:
-            pass
-        # Sentry/monitoring hook
+            rooms = _reply_rooms(convo_id, chat_id, channel)
+            for room in rooms:
+                sio.emit('new_message', {
+                    'id': ai_message_id,
+                    'convo_id': convo_id,
+                    'username': 'AI Bot',
+                    'message': ai_reply,
+                    'sender': 'bot',
+                    'timestamp': timestamp,
+                    'chat_id': chat_id,
+                    'channel': channel,
+                    'stream_id': stream_id
+                }, room=room)
+            save_checkpoint(checkpoint_key, emitted=1)
+            logger.info(f"[CID:{correlation_id}] Emitted AI response via Socket.IO to rooms {rooms}")
+        except Exception as e:
+            logger.error(f"[CID:{correlation_id}] Failed to emit Socket.IO event for AI reply: {str(e)}")
+
+    if channel == 'whatsapp' and "sent" not in checkpoint:
         try:
-            # sentry_sdk.capture_exception(e)
-            pass
-        except Exception:
-            pass
-        raise self.retry(exc=e, countdown=120, max_retries=3)
+            if _send_whatsapp(chat_id, ai_reply, correlation_id, ai_message_id):
+                save_checkpoint(checkpoint_key, sent=1)
+        except TwilioSendError as e:
+            logger.error(f"[CID:{correlation_id}] Twilio rejected WhatsApp reply to {chat_id}: {e}")
+            send_to_dead_letter_queue({'convo_id': convo_id, 'ai_message_id': ai_message_id, 'chat_id': chat_id}, reason=str(e), correlation_id=correlation_id)
+        except Exception as e:
+            logger.error(f"[CID:{correlation_id}] Failed to send WhatsApp message to {chat_id}: {e}", exc_info=True)
+            metrics.incr("whatsapp.send_retries")
+            raise self.retry(exc=e, countdown=retry_countdown(e, self.request.retries))
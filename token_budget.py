@@ -0,0 +1,137 @@
+"""
+Token counting and token-budgeted history packing for OpenAI prompts.
+
+Conversation history is trimmed by tokens, not by message count: the most
+recent turns are packed until the model's history budget is used up, so ten
+one-word messages don't starve the context and a few long ones can't blow
+the budget. Every stored message carries its token count (messages.token_count
+and the Redis context cache), so packing is a sum, not a re-tokenization.
+
+Counts come from tiktoken when it is installed. Its encoding files are
+fetched at build time (``python token_budget.py`` in render_build.sh and
+every worker's build command) into TIKTOKEN_CACHE_DIR, so processes load
+them offline. Without tiktoken, or while an encoding can't be loaded, a
+chars/4 estimate is used, which is close enough for English and Spanish
+chat text. A failed load is retried after TOKENIZER_RETRY_SECONDS rather
+than leaving the process on estimates for good.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger("chat_server")
+
+# tiktoken reads this on every load; default to the cache the build fills
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".tiktoken_cache"))
+TOKENIZER_RETRY_SECONDS = float(os.getenv("TOKENIZER_RETRY_SECONDS", "300"))
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+AI_MODEL = os.getenv("AI_MODEL", "gpt-4o-mini")
+
+# Tokens of history (not counting the system prompt and reply) per model
+MODEL_HISTORY_BUDGETS = {
+    "gpt-4o-mini": 2000,
+    "gpt-4o": 2000,
+    "gpt-3.5-turbo": 1500,
+}
+DEFAULT_HISTORY_BUDGET = 1500
+# Per-message framing tokens the chat format adds (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+ESTIMATED_CHARS_PER_TOKEN = 4
+
+
+def history_budget(model=AI_MODEL):
+    """History token budget for a model; AI_HISTORY_TOKEN_BUDGETS='{"gpt-4o-mini": 3000}' overrides."""
+    overrides = {}
+    try:
+        overrides = json.loads(os.getenv("AI_HISTORY_TOKEN_BUDGETS", "{}"))
+    except ValueError:
+        logger.warning("AI_HISTORY_TOKEN_BUDGETS is not valid JSON; using default budgets")
+    return int(overrides.get(model, MODEL_HISTORY_BUDGETS.get(model, DEFAULT_HISTORY_BUDGET)))
+
+
+_encodings = {}
+_failed_at = {}
+_encoding_lock = threading.Lock()
+
+
+def _load_encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def _encoding(model):
+    """The model's tiktoken encoding, or None (estimate) if it can't be loaded right now."""
+    encoding = _encodings.get(model)
+    if encoding is not None or tiktoken is None:
+        return encoding
+    if time.monotonic() - _failed_at.get(model, -TOKENIZER_RETRY_SECONDS) < TOKENIZER_RETRY_SECONDS:
+        return None
+    with _encoding_lock:
+        if model in _encodings:
+            return _encodings[model]
+        try:
+            encoding = _encodings[model] = _load_encoding(model)
+        except Exception as e:
+            # e.g. the build didn't fetch the encoding and there's no network
+            _failed_at[model] = time.monotonic()
+            logger.warning(f"⚠️ tiktoken encoding for {model} unavailable, estimating tokens for {TOKENIZER_RETRY_SECONDS:.0f}s: {e}")
+            return None
+    return encoding
+
+
+def preload(model=AI_MODEL):
+    """Load the tokenizer now instead of on the first message."""
+    if _encoding(model) is not None:
+        logger.info(f"✅ Tokenizer for {model} loaded")
+
+
+def count_tokens(text, model=AI_MODEL):
+    """Tokens in text for model (estimated when tiktoken isn't available)."""
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is None:
+        return len(text) // ESTIMATED_CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def pack_history(conversation_history, budget, model=AI_MODEL):
+    """
+    Keep the most recent turns whose tokens fit in budget, oldest first. The
+    latest turn is always kept. Turns may carry a precomputed "tokens" count;
+    the returned turns are plain {"role", "content"} messages.
+    """
+    packed = []
+    used = 0
+    for turn in reversed(conversation_history):
+        tokens = turn.get("tokens")
+        if tokens is None:
+            tokens = count_tokens(turn.get("content", ""), model)
+        tokens += MESSAGE_OVERHEAD_TOKENS
+        if packed and used + tokens > budget:
+            break
+        packed.append({"role": turn["role"], "content": turn["content"]})
+        used += tokens
+    packed.reverse()
+    return packed, used
+
+
+if __name__ == "__main__":
+    # Build step: fetch the encodings into TIKTOKEN_CACHE_DIR so processes load them offline
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    if tiktoken is None:
+        sys.exit("tiktoken is not installed")
+    for model in {AI_MODEL, *MODEL_HISTORY_BUDGETS}:
+        _load_encoding(model)
+    print(f"Tokenizer encodings cached in {os.environ['TIKTOKEN_CACHE_DIR']}")
@@ -0,0 +1,169 @@
+"""
+Rate-limited, connection-pooled WhatsApp sender for the Twilio Messages API.
+
+- One pooled, keep-alive requests.Session per process, sized for the
+  delivery worker's concurrency, instead of a fresh connection per send.
+- A token bucket per sender number, kept in Redis so every delivery worker
+  shares it (WHATSAPP_SEND_RATE messages/second, bursts of
+  WHATSAPP_SEND_BURST).
+- A 429 from Twilio pauses that sender number cluster-wide for the
+  Retry-After interval and raises TwilioRateLimited, so the caller can retry
+  after exactly that long instead of a fixed delay.
+- send_many() dispatches a batch concurrently through the same limiter.
+
+TWILIO_API_BASE can point at fake_twilio.py to measure throughput offline.
+"""
+
+import os
+import time
+import random
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("chat_server")
+
+TWILIO_API_BASE = os.getenv("TWILIO_API_BASE", "https://api.twilio.com").rstrip("/")
+WHATSAPP_SEND_RATE = float(os.getenv("WHATSAPP_SEND_RATE", "20"))
+WHATSAPP_SEND_BURST = int(os.getenv("WHATSAPP_SEND_BURST", "40"))
+WHATSAPP_SEND_CONCURRENCY = int(os.getenv("WHATSAPP_SEND_CONCURRENCY", "20"))
+WHATSAPP_HTTP_POOL_SIZE = int(os.getenv("WHATSAPP_HTTP_POOL_SIZE", "50"))
+WHATSAPP_HTTP_TIMEOUT = float(os.getenv("WHATSAPP_HTTP_TIMEOUT", "15"))
+# Longest we'll wait in-process for a token before handing back to Celery
+WHATSAPP_MAX_LOCAL_WAIT = float(os.getenv("WHATSAPP_MAX_LOCAL_WAIT", "5"))
+DEFAULT_RETRY_AFTER = 5
+
+# Returns 0 if a token was taken, otherwise the milliseconds to wait.
+# Uses the Redis clock so workers with skewed clocks share one bucket.
+_token_bucket_script = """
+local pause_ms = redis.call('pttl', KEYS[2])
+if pause_ms > 0 then
+    return pause_ms
+end
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('time')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate / 1000)
+local wait_ms = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait_ms = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('hset', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('pexpire', KEYS[1], 60000)
+return wait_ms
+"""
+
+
+class TwilioSendError(Exception):
+    """Twilio rejected the message; retrying the same request won't help."""
+
+
+class TwilioRateLimited(Exception):
+    """Twilio (or the local limiter) asked us to slow down."""
+
+    def __init__(self, retry_after, message="WhatsApp send rate-limited"):
+        super().__init__(f"{message}; retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class WhatsAppSender:
+    """Sends WhatsApp messages through the Twilio REST API."""
+
+    def __init__(self, redis_client, account_sid, auth_token, from_number):
+        self._redis = redis_client
+        self._acquire = redis_client.register_script(_token_bucket_script)
+        self.account_sid = account_sid
+        self.from_number = from_number
+        self.session = requests.Session()
+        self.session.auth = (account_sid or "", auth_token or "")
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=WHATSAPP_HTTP_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @property
+    def configured(self):
+        return bool(self.account_sid and self.from_number)
+
+    def _bucket_keys(self):
+        return [f"whatsapp:bucket:{self.from_number}", f"whatsapp:pause:{self.from_number}"]
+
+    def _wait_for_token(self):
+        waited = 0.0
+        while True:
+            wait_ms = self._acquire(keys=self._bucket_keys(), args=[WHATSAPP_SEND_RATE, WHATSAPP_SEND_BURST])
+            if not wait_ms:
+                return
+            wait = wait_ms / 1000
+            if waited + wait > WHATSAPP_MAX_LOCAL_WAIT:
+                # Don't hold a worker slot through a long pause
+                raise TwilioRateLimited(wait, "WhatsApp sender is paused")
+            time.sleep(wait)
+            waited += wait
+
+    def _pause(self, retry_after):
+        self._redis.set(self._bucket_keys()[1], 1, px=int(retry_after * 1000))
+
+    def send(self, to_number, body, status_callback=None):
+        """Send one message and return its Twilio SID."""
+        self._wait_for_token()
+        data = {
+            "From": f"whatsapp:{self.from_number}",
+            "To": f"whatsapp:{to_number}",
+            "Body": body,
+        }
+        if status_callback:
+            data["StatusCallback"] = status_callback
+        response = self.session.post(
+            f"{TWILIO_API_BASE}/2010-04-01/Accounts/{self.account_sid}/Messages.json",
+            data=data,
+            timeout=WHATSAPP_HTTP_TIMEOUT
+        )
+        if response.status_code == 429:
+            try:
+                retry_after = float(response.headers.get("Retry-After", DEFAULT_RETRY_AFTER))
+            except ValueError:
+                retry_after = DEFAULT_RETRY_AFTER
+            self._pause(retry_after)
+            raise TwilioRateLimited(retry_after)
+        if response.status_code >= 500:
+            # requests.HTTPError is retried by the calling task
+            response.raise_for_status()
+        if response.status_code >= 400:
+            try:
+                error = response.json()
+            except ValueError:
+                error = {"message": response.text}
+            raise TwilioSendError(f"Twilio error {error.get('code')}: {error.get('message')}")
+        return response.json()["sid"]
+
+    def send_many(self, messages):
+        """
+        Send (to_number, body) pairs concurrently. Returns one result per
+        message, in order: the SID, or the exception that send() raised.
+        """
+        def _send(message):
+            try:
+                return self.send(*message)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=WHATSAPP_SEND_CONCURRENCY) as executor:
+            return list(executor.map(_send, messages))
+
+
+def retry_countdown(exc, attempt):
+    """Celery retry countdown for a failed send: Twilio's Retry-After, else exponential."""
+    if isinstance(exc, TwilioRateLimited):
+        base = exc.retry_after
+    else:
+        base = min(60, 2 ** attempt * 5)
+    # Jitter so a burst of rate-limited tasks doesn't come back in lockstep
+    return base + random.uniform(0, base * 0.2 + 0.5)